@@ -0,0 +1,127 @@
+'''
+    Benchmark of the media id computation of StreamProvider.readMedia:
+    reading whole files against chunked mmap hashing and the manifest.
+
+    Every method runs in a child process to report its own peak memory.
+    The whole-file method needs several times the file size in memory, it
+    is skipped for files bigger than LEGACY_LIMIT_MB.
+
+    Usage: python3 benchmarks/media_hashing.py [files] [size_mb] [dir]
+'''
+
+# pylint: disable=C0103
+# pylint: disable=C0413
+# pylint: disable=E0401
+
+import hashlib
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "iceflix"))
+from media_hashing import MediaManifest, MediaScanner, media_id
+
+LEGACY_LIMIT_MB = 512
+BLOCK = 1 << 24
+
+
+def create_files(directory, files, size_mb):
+    """Create `files` files of random content and return their paths."""
+    paths = []
+    for num in range(files):
+        path = os.path.join(directory, f"media{num}.mp4")
+        with open(path, "wb") as media_file:
+            remaining = size_mb << 20
+            while remaining:
+                block = min(BLOCK, remaining)
+                media_file.write(os.urandom(block))
+                remaining -= block
+        paths.append(path)
+    return paths
+
+
+def legacy(paths, _):
+    """Previous readMedia implementation."""
+    ids = []
+    for path in paths:
+        with open(path, "rb") as media_file:
+            ids.append(hashlib.sha256(str(media_file.read()).encode()).hexdigest())
+    return ids
+
+
+def chunked(paths, _):
+    """Chunked mmap hashing without manifest."""
+    return [media_id(path) for path in paths]
+
+
+def parallel(paths, manifest_path):
+    """Chunked hashing in a pool with one process per CPU, without manifest."""
+    found = {}
+    MediaScanner(MediaManifest(manifest_path + ".unused")).scan(paths, found.__setitem__)
+    return [found[path] for path in paths]
+
+
+def manifest(paths, manifest_path):
+    """Hashing through the manifest."""
+    media_manifest = MediaManifest(manifest_path)
+    ids = [media_manifest.media_id(path) for path in paths]
+    media_manifest.save()
+    return ids
+
+
+def child(function, paths, manifest_path, results):
+    """Run a method and send back its time, peak memory and ids."""
+    start = time.perf_counter()
+    ids = function(paths, manifest_path)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((elapsed, peak, ids))
+
+
+def measure(function, paths, manifest_path):
+    """Run a method in a new process."""
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=child, args=(function, paths, manifest_path, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main(argv):
+    """Run the benchmark."""
+    files = int(argv[1]) if len(argv) > 1 else 2
+    size_mb = int(argv[2]) if len(argv) > 2 else 2048
+    base_dir = argv[3] if len(argv) > 3 else None
+
+    with tempfile.TemporaryDirectory(dir=base_dir) as tmp_dir:
+        paths = create_files(tmp_dir, files, size_mb)
+        manifest_path = os.path.join(tmp_dir, "manifest.json")
+        runs = [
+            ("chunked", chunked),
+            ("parallel", parallel),
+            ("manifest cold", manifest),
+            ("manifest warm", manifest),
+        ]
+        if size_mb <= LEGACY_LIMIT_MB:
+            runs.insert(0, ("whole file", legacy))
+
+        print(f"{files} files of {size_mb} MiB, {os.cpu_count()} CPUs")
+        expected = None
+        for label, function in runs:
+            elapsed, peak, ids = measure(function, paths, manifest_path)
+            if expected is None:
+                expected = ids
+            assert ids == expected
+            print(f"{label:14} {elapsed:8.3f} s  "
+                  f"{files * size_mb / elapsed:9.1f} MiB/s  peak RSS {peak / 1024:8.1f} MiB")
+        if size_mb > LEGACY_LIMIT_MB:
+            print(f"whole file     skipped, needs about {4 * size_mb} MiB per file")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
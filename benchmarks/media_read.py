@@ -0,0 +1,145 @@
+'''
+    Benchmark of the pull-based playback paths: MediaReader.read over Ice,
+    one call at a time and with a window of readAsync calls, against the
+    HTTP server, with a single GET and with sequential range requests.
+
+    The provider runs in a child process with a fixed token, serving a
+    file of random content.
+
+    Usage: python3 benchmarks/media_read.py [size_mb] [window] [range_mb]
+'''
+
+# pylint: disable=C0103
+# pylint: disable=C0413
+# pylint: disable=E0401
+
+import http.client
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "iceflix"))
+import Ice
+from media_http import MediaHTTPServer
+from streaming import MAX_READ_SIZE, StreamProvider
+import IceFlix
+
+BLOCK = 1 << 24
+TOKEN = "benchmark"
+MEDIA_ID = "benchmark"
+RECV_SIZE = 1 << 20
+
+
+def serve_media(directory, connection):
+    """Child process: serve the media over Ice and HTTP until told to stop."""
+    os.chdir(directory)
+    provider = StreamProvider()
+    provider.checkToken = lambda user_token: "benchmark" if user_token == TOKEN else None
+    provider.media_available = {MEDIA_ID: MEDIA_ID}
+    provider.http_server = MediaHTTPServer(port=0)
+    provider.http_server.start()
+    with Ice.initialize() as communicator:
+        adapter = communicator.createObjectAdapterWithEndpoints(
+            "StreamProvider", "tcp -h 127.0.0.1")
+        adapter.activate()
+        connection.send(str(adapter.addWithUUID(provider)))
+        connection.recv()
+    provider.http_server.stop()
+
+
+def ice_read(reader, size, window):
+    """Read the whole media keeping `window` reads in flight."""
+    received = 0
+    pending = deque()
+    requested = 0
+    while True:
+        while requested < size and len(pending) < window:
+            pending.append(reader.readAsync(requested, MAX_READ_SIZE))
+            requested += MAX_READ_SIZE
+        if not pending:
+            break
+        received += len(pending.popleft().result())
+    return received
+
+
+def http_get(url, range_size):
+    """Read the whole media with one GET, or with ranges of `range_size` bytes."""
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port)
+    path = f"{parts.path}?{parts.query}"
+    headers = {"Authorization": f"Bearer {TOKEN}"}
+    buffer = bytearray(RECV_SIZE)
+    received = 0
+    offset = 0
+    size = None
+    while size is None or offset < size:
+        if range_size:
+            headers["Range"] = f"bytes={offset}-{offset + range_size - 1}"
+        connection.request("GET", path, headers=headers)
+        response = connection.getresponse()
+        assert response.status in (200, 206), response.status
+        if size is None:
+            size = int(response.headers["Content-Range"].split("/")[1]) \
+                if range_size else int(response.headers["Content-Length"])
+        length = int(response.headers["Content-Length"])
+        while True:
+            read = response.readinto(buffer)
+            if not read:
+                break
+            received += read
+        offset += length
+    connection.close()
+    return received
+
+
+def main(argv):
+    """Run the benchmark."""
+    size_mb = int(argv[1]) if len(argv) > 1 else 1024
+    window = int(argv[2]) if len(argv) > 2 else 8
+    range_mb = int(argv[3]) if len(argv) > 3 else 4
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.mkdir(os.path.join(tmp_dir, "resources"))
+        with open(os.path.join(tmp_dir, "resources", MEDIA_ID + ".mp4"), "wb") as media_file:
+            remaining = size_mb << 20
+            while remaining:
+                block = min(BLOCK, remaining)
+                media_file.write(os.urandom(block))
+                remaining -= block
+
+        parent, child = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=serve_media, args=(tmp_dir, child))
+        server.start()
+        results = []
+        with Ice.initialize() as communicator:
+            provider = IceFlix.StreamProviderPrx.uncheckedCast(
+                communicator.stringToProxy(parent.recv()))
+            reader = provider.getReader(MEDIA_ID, TOKEN)
+            size = reader.getSize()
+            url = reader.getUrl()
+            runs = [
+                ("Ice read", lambda: ice_read(reader, size, 1)),
+                (f"Ice window {window}", lambda: ice_read(reader, size, window)),
+                ("HTTP GET", lambda: http_get(url, 0)),
+                (f"HTTP {range_mb} MiB ranges", lambda: http_get(url, range_mb << 20)),
+            ]
+            for label, run in runs:
+                start = time.perf_counter()
+                received = run()
+                elapsed = time.perf_counter() - start
+                assert received == size, (label, received, size)
+                results.append((label, elapsed))
+            reader.stop()
+        parent.send(False)
+        server.join()
+
+    for label, elapsed in results:
+        print(f"{label:20} {size / 1e6 / elapsed:9.1f} MB/s ({size_mb} MiB in {elapsed:.3f} s)")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,96 @@
+'''
+    Benchmark of MediaCatalog.getTilesByTags: linear scan against the
+    per-user inverted tag index of CatalogStore.
+
+    Usage: python3 benchmarks/tag_index.py [titles] [tags] [queries]
+'''
+
+# pylint: disable=C0103
+# pylint: disable=C0413
+# pylint: disable=E0401
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "iceflix"))
+from catalog import CatalogStore
+
+USER = "bench"
+TAGS_PER_TITLE = 5
+
+
+def build_catalog(titles, tags):
+    """Create a synthetic catalog database for a single user."""
+    rng = random.Random(42)
+    vocabulary = [f"tag{num}" for num in range(tags)]
+    info = {}
+    user_tags = {}
+    for num in range(titles):
+        media_id = f"media{num}"
+        info[media_id] = f"Title {num}"
+        user_tags[media_id] = rng.sample(vocabulary, TAGS_PER_TITLE)
+    return {"info": info, "tags": {USER: user_tags}}, vocabulary
+
+
+def scan(tags_user, tags, include_all_tags):
+    """Previous getTilesByTags implementation."""
+    ids = []
+    if include_all_tags:
+        for media_id in tags_user.keys():
+            if all(elem in tags_user[media_id] for elem in tags):
+                ids.append(media_id)
+        return ids
+    for media_id in tags_user.keys():
+        if any(elem in tags_user[media_id] for elem in tags):
+            ids.append(media_id)
+    return ids
+
+
+def measure(function, queries):
+    """Run all the queries and return the mean time per query."""
+    start = time.perf_counter()
+    for tags, include_all_tags in queries:
+        function(tags, include_all_tags)
+    return (time.perf_counter() - start) / len(queries)
+
+
+def main(argv):
+    """Run the benchmark."""
+    titles = int(argv[1]) if len(argv) > 1 else 100000
+    tags = int(argv[2]) if len(argv) > 2 else 1000
+    num_queries = int(argv[3]) if len(argv) > 3 else 50
+
+    data, vocabulary = build_catalog(titles, tags)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "catalog.json")
+        with open(path, "w", encoding="utf-8") as db:
+            json.dump(data, db)
+        store = CatalogStore(path)
+
+        rng = random.Random(7)
+        queries = []
+        for _ in range(num_queries):
+            queries.append((rng.sample(vocabulary, 2), True))
+            queries.append((rng.sample(vocabulary, 3), False))
+
+        tags_user = data["tags"][USER]
+        for tags_query, include_all_tags in queries:
+            assert scan(tags_user, tags_query, include_all_tags) == \
+                store.media_by_tags(USER, tags_query, include_all_tags)
+
+        scan_time = measure(lambda t, a: scan(tags_user, t, a), queries)
+        index_time = measure(lambda t, a: store.media_by_tags(USER, t, a), queries)
+        store.close()
+
+    print(f"{titles} titles, {tags} tags, {len(queries)} queries")
+    print(f"scan:  {scan_time * 1000:.3f} ms/query")
+    print(f"index: {index_time * 1000:.3f} ms/query")
+    print(f"speedup: {scan_time / index_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
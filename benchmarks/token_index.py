@@ -0,0 +1,64 @@
+'''
+    Microbenchmark of Authenticator.isAuthorized and Authenticator.whois:
+    linear scan of the user -> token map against the token -> user index.
+
+    Usage: python3 benchmarks/token_index.py [tokens] [lookups]
+'''
+
+# pylint: disable=C0103
+# pylint: disable=C0413
+# pylint: disable=E0401
+
+import os
+import random
+import secrets
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "iceflix"))
+os.chdir(ROOT)
+from authenticator import Authenticator
+
+
+def scan_whois(user_tokens, user_token):
+    """Previous whois implementation."""
+    for user in user_tokens.keys():
+        if user_token == user_tokens[user]:
+            return user
+    return None
+
+
+def measure(function, tokens):
+    """Look up every token and return the mean time per lookup."""
+    start = time.perf_counter()
+    for user_token in tokens:
+        function(user_token)
+    return (time.perf_counter() - start) / len(tokens)
+
+
+def main(argv):
+    """Run the benchmark."""
+    num_tokens = int(argv[1]) if len(argv) > 1 else 1000000
+    num_lookups = int(argv[2]) if len(argv) > 2 else 20
+
+    servant = Authenticator()
+    servant.set_tokens({f"user{num}": secrets.token_urlsafe(40) for num in range(num_tokens)})
+
+    rng = random.Random(42)
+    tokens = rng.sample(list(servant.token_users), num_lookups)
+    tokens += [secrets.token_urlsafe(40) for _ in range(num_lookups)]
+    for user_token in tokens:
+        assert scan_whois(servant.user_tokens, user_token) == servant.token_users.get(user_token)
+
+    scan_time = measure(lambda token: scan_whois(servant.user_tokens, token), tokens)
+    index_time = measure(servant.isAuthorized, tokens)
+
+    print(f"{num_tokens} live tokens, {len(tokens)} lookups (half of them unknown)")
+    print(f"scan:  {scan_time * 1e6:.1f} us/lookup")
+    print(f"index: {index_time * 1e6:.3f} us/lookup")
+    print(f"speedup: {scan_time / index_time:.0f}x")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
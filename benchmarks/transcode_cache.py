@@ -0,0 +1,79 @@
+'''
+    Benchmark of the CPU time per stream of RTSPEmitter: encoding every
+    play against the transcoding cache, cold (encode and store) and warm
+    (remux the stored output).
+
+    Without a media argument a 30 s Theora test video is generated, so the
+    source is not H.264 and goes through the cache. Requires gst-launch-1.0.
+
+    Usage: python3 benchmarks/transcode_cache.py [media]
+'''
+
+# pylint: disable=C0103
+# pylint: disable=C0413
+# pylint: disable=E0401
+# pylint: disable=W0212
+
+import os
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "iceflix"))
+from rtsputils import RTSPEmitter, TranscodeCache
+
+TEST_VIDEO_PIPE = (
+    "videotestsrc num-buffers=900 ! video/x-raw,width=1280,height=720,framerate=30/1 ! "
+    'theoraenc ! oggmux ! filesink location="{}"'
+)
+PORT = 5004
+
+
+def children_cpu():
+    """CPU seconds used by the finished child processes."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def stream(media, cache):
+    """Stream a media to a local port and return the CPU seconds used."""
+    start = children_cpu()
+    emitter = RTSPEmitter(media, "127.0.0.1", PORT, cache)
+    print(f"  pipe: {emitter._pipe_.split(' ! ')[1]} ...")
+    emitter.start()
+    emitter.wait()
+    return children_cpu() - start
+
+
+def main(argv):
+    """Run the benchmark."""
+    if shutil.which("gst-launch-1.0") is None:
+        print("gst-launch-1.0 not found")
+        return 1
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if len(argv) > 1:
+            media = argv[1]
+        else:
+            media = os.path.join(tmp_dir, "test.ogv")
+            subprocess.run(shlex.split(
+                f"gst-launch-1.0 -q {TEST_VIDEO_PIPE.format(media)}"), check=True)
+        cache = TranscodeCache(os.path.join(tmp_dir, "cache"))
+
+        print("no cache:")
+        uncached = stream(media, None)
+        print("cold cache:")
+        cold = stream(media, cache)
+        print("warm cache:")
+        warm = stream(media, cache)
+
+    print(f"no cache:   {uncached:7.2f} CPU s/stream")
+    print(f"cold cache: {cold:7.2f} CPU s/stream")
+    print(f"warm cache: {warm:7.2f} CPU s/stream")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,121 @@
+'''
+    Benchmark of StreamProvider.uploadMedia: the previous receive loop of
+    10 byte chunks against receive_upload one chunk at a time, which is
+    what uploadMedia does when the caller sends no SHA-256, and with a
+    window of receiveAsync calls, which needs the SHA-256.
+
+    The uploader runs in a child process serving the file over TCP like
+    the client does. The previous loop is only run over the first
+    `legacy_mb` MiB, it makes a round trip every 10 bytes.
+
+    Usage: python3 benchmarks/upload.py [size_mb] [legacy_mb] [chunk] [window]
+'''
+
+# pylint: disable=C0103
+# pylint: disable=C0413
+# pylint: disable=E0401
+# pylint: disable=W0613
+
+import hashlib
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "iceflix"))
+import Ice
+from media_hashing import media_digests
+from media_upload import UPLOAD_CHUNK_SIZE, UPLOAD_WINDOW, receive_upload
+import IceFlix
+
+BLOCK = 1 << 24
+LEGACY_CHUNK_SIZE = 10
+
+
+def serve_uploads(path, connection):
+    """Child process: serve one MediaUploader per request over the pipe."""
+
+    class FileUploader(IceFlix.MediaUploader):
+        """MediaUploader reading a local file."""
+
+        def __init__(self):
+            self.file = open(path, "rb")  # pylint: disable=consider-using-with
+
+        def receive(self, size, current=None):
+            return self.file.read(size)
+
+        def close(self, current=None):
+            self.file.close()
+
+    with Ice.initialize(["--Ice.MessageSizeMax=0"]) as communicator:
+        adapter = communicator.createObjectAdapterWithEndpoints(
+            "Uploader", "tcp -h 127.0.0.1")
+        adapter.activate()
+        while connection.recv():
+            connection.send(str(adapter.addWithUUID(FileUploader())))
+
+
+def legacy(uploader, size):
+    """Previous uploadMedia loop."""
+    file_bytes = bytes()
+    while True:
+        chunk = uploader.receive(LEGACY_CHUNK_SIZE)
+        file_bytes += chunk
+        if len(file_bytes) >= size:
+            break
+    return hashlib.sha256(str(file_bytes).encode()).hexdigest()
+
+
+def main(argv):
+    """Run the benchmark."""
+    size_mb = int(argv[1]) if len(argv) > 1 else 1024
+    legacy_mb = float(argv[2]) if len(argv) > 2 else 1
+    chunk_size = int(argv[3]) if len(argv) > 3 else UPLOAD_CHUNK_SIZE
+    window = int(argv[4]) if len(argv) > 4 else UPLOAD_WINDOW
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source = os.path.join(tmp_dir, "source.mp4")
+        with open(source, "wb") as media_file:
+            remaining = size_mb << 20
+            while remaining:
+                block = min(BLOCK, remaining)
+                media_file.write(os.urandom(block))
+                remaining -= block
+
+        parent, child = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=serve_uploads, args=(source, child))
+        server.start()
+        with Ice.initialize(["--Ice.MessageSizeMax=0"]) as communicator:
+            def uploader():
+                parent.send(True)
+                return IceFlix.MediaUploaderPrx.uncheckedCast(
+                    communicator.stringToProxy(parent.recv()))
+
+            legacy_size = int(legacy_mb * (1 << 20))
+            start = time.perf_counter()
+            legacy(uploader(), legacy_size)
+            legacy_time = time.perf_counter() - start
+
+            destination = os.path.join(tmp_dir, "uploaded.mp4")
+            size = size_mb << 20
+            source_id, source_sha256 = media_digests(source)
+            results = []
+            for label, sha256 in (("window 1", ""), (f"window {window}", source_sha256)):
+                start = time.perf_counter()
+                uploaded_id, _ = receive_upload(uploader(), size, destination, chunk_size,
+                                                window, sha256)
+                results.append((label, time.perf_counter() - start))
+                assert uploaded_id == source_id
+        parent.send(False)
+        server.join()
+
+    print(f"previous loop: {legacy_size / 1e6 / legacy_time:8.2f} MB/s "
+          f"({legacy_mb} MiB in {legacy_time:.3f} s)")
+    for label, upload_time in results:
+        print(f"receive_upload {label}: {size / 1e6 / upload_time:7.2f} MB/s "
+              f"({size_mb} MiB in {upload_time:.3f} s, chunk {chunk_size})")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
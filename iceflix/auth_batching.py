@@ -0,0 +1,92 @@
+"""Module to batch token checks against an Authenticator.
+
+Concurrent `isAuthorized`/`whois` checks issued within a short window are
+sent together with a single `areAuthorized`/`whoisMany` call.
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import Future
+
+import Ice
+
+try:
+    import IceFlix
+except ImportError:
+    Ice.loadSlice(os.path.join(os.path.dirname(__file__), "iceflix.ice"))
+    import IceFlix
+
+BATCH_WINDOW = 0.005
+MAX_BATCH = 500
+BATCH_WINDOW_PROPERTY = "IceFlix.AuthBatchWindow"
+
+
+class AuthBatcher:
+    """Collects pending token checks and resolves them in batches."""
+
+    def __init__(self, get_authenticator, window=BATCH_WINDOW, max_batch=MAX_BATCH):
+        """Initialize a batcher.
+
+        The `get_authenticator` argument should be a callable returning an
+        IceFlix.AuthenticatorPrx. It may raise IceFlix.TemporaryUnavailable,
+        which is then raised to every caller of the batch.
+
+        The `window` argument is the time in seconds the first check of a
+        batch waits for others to join. A batch is sent right away when it
+        reaches `max_batch` tokens.
+        """
+        self.get_authenticator = get_authenticator
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = {"areAuthorized": [], "whoisMany": []}
+        self.lock = threading.Lock()
+
+    def is_authorized(self, token):
+        """Return whether the token is valid."""
+        return self.submit("areAuthorized", token)
+
+    def whois(self, token):
+        """Return the user of a token or an empty string if invalid."""
+        return self.submit("whoisMany", token)
+
+    def submit(self, operation, token):
+        """Add a check to the next batch and wait for its result."""
+        future = Future()
+        flush_now = False
+        with self.lock:
+            pending = self.pending[operation]
+            pending.append((token, future))
+            if len(pending) >= self.max_batch:
+                flush_now = True
+            elif len(pending) == 1:
+                timer = threading.Timer(self.window, self.flush, args=(operation,))
+                timer.daemon = True
+                timer.start()
+        if flush_now:
+            self.flush(operation)
+        return future.result()
+
+    def flush(self, operation):
+        """Send the pending checks of an operation."""
+        with self.lock:
+            batch = self.pending[operation]
+            self.pending[operation] = []
+        if not batch:
+            return
+        tokens = list(dict.fromkeys(token for token, _ in batch))
+        try:
+            auth_prx = self.get_authenticator()
+            answers = getattr(auth_prx, operation)(tokens)
+            if len(answers) != len(tokens):
+                logging.warning("Batch %s of %d tokens got %d results",
+                                operation, len(tokens), len(answers))
+                raise IceFlix.TemporaryUnavailable()
+            results = dict(zip(tokens, answers))
+            for token, future in batch:
+                future.set_result(results[token])
+        except Exception as ex:  # pylint: disable=broad-except
+            logging.debug("Batch %s of %d tokens failed: %s", operation, len(tokens), ex)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(ex)
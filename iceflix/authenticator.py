@@ -17,7 +17,7 @@
 
 from distutils.log import error
 import logging
-from time import sleep
+from time import sleep, monotonic
 import uuid
 import random
 import os
@@ -25,6 +25,9 @@ import sys
 import json
 import threading
 import secrets
+import heapq
+import time
+from collections import OrderedDict, deque
 
 import Ice
 import IceStorm
@@ -35,9 +38,25 @@ except ImportError:
     Ice.loadSlice(os.path.join(os.path.dirname(__file__), "iceflix.ice"))
     import IceFlix
 from service_announcement import (
+    DataTransfers,
     ServiceAnnouncementsListener,
     ServiceAnnouncementsSender,
 )
+from token_signing import (
+    REVOKED_AT_CONTEXT,
+    issue_token,
+    load_key,
+)
+
+TOKEN_TTL = 120.0
+CHANGE_LOG_SIZE = 100000
+# Version vector and live tokens kept across restarts next to users.json
+STATE_PATH = "./users_state.json"
+# Seconds after the start a replica that could not sync serves its own data
+JOIN_TIMEOUT = 30.0
+# Revocations remembered in case they arrive before the token they revoke
+EARLY_REVOCATIONS_SIZE = 10000
+REVOCATION_KINDS = (IceFlix.UserChangeKind.UserRemoved, IceFlix.UserChangeKind.TokenRevoked)
 
 def readJSON():
     # pylint: disable=W1514
@@ -51,6 +70,21 @@ def writeJSON(data):
     db = open("./users.json", "w")
     json.dump(data, db, indent=6)
 
+def readState():
+    # pylint: disable=W1514
+    try:
+        with open(STATE_PATH) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return None
+
+def writeState(data):
+    # pylint: disable=W1514
+    tmp_path = STATE_PATH + ".tmp"
+    with open(tmp_path, "w") as state_file:
+        json.dump(data, state_file)
+    os.replace(tmp_path, STATE_PATH)
+
 def getTopic(communicator, topic_name):
     topic_manager = IceStorm.TopicManagerPrx.checkedCast(
         communicator.propertyToProxy("IceStorm.TopicManager"),
@@ -62,58 +96,458 @@ def getTopic(communicator, topic_name):
 
     return topic
 
+def change_stream(srv_id, kind):
+    """Version vector key of the changes of `kind` made by `srv_id`.
+
+    Changes are numbered per origin and topic, IceStorm does not order the
+    events of UserUpdates and Revocations between them.
+    """
+    topic = "Revocations" if kind in REVOCATION_KINDS else "UserUpdates"
+    return f"{srv_id}/{topic}"
+
+class TokenExpiryScheduler:
+    ''' Expires the tokens of all users from a single thread
+
+    Deadlines are kept in a heap. Rescheduling or cancelling a token only
+    updates `deadlines`, stale heap entries are skipped when popped. Every
+    token that expires at the same time is handed to `on_expired` at once.
+    '''
+    def __init__(self, on_expired, ttl=TOKEN_TTL):
+        self.on_expired = on_expired
+        self.ttl = ttl
+        self.heap = []
+        self.deadlines = {}
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+
+    def schedule(self, token, ttl=None):
+        deadline = monotonic() + (self.ttl if ttl is None else ttl)
+        with self.condition:
+            self.deadlines[token] = deadline
+            heapq.heappush(self.heap, (deadline, token))
+            if self.heap[0][1] == token:
+                self.condition.notify()
+
+    def cancel(self, token):
+        with self.condition:
+            self.deadlines.pop(token, None)
+
+    def remaining(self, token):
+        """Seconds left before `token` expires, None if it is not scheduled."""
+        with self.condition:
+            deadline = self.deadlines.get(token)
+        return None if deadline is None else max(0.0, deadline - monotonic())
+
+    def pop_expired(self):
+        expired = []
+        now = monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            deadline, token = heapq.heappop(self.heap)
+            if self.deadlines.get(token) == deadline:
+                del self.deadlines[token]
+                expired.append(token)
+        return expired
+
+    def run(self):
+        while True:
+            with self.condition:
+                expired = self.pop_expired()
+                while not expired and not self.stopped:
+                    timeout = self.heap[0][0] - monotonic() if self.heap else None
+                    self.condition.wait(timeout)
+                    expired = self.pop_expired()
+                if self.stopped:
+                    return
+            try:
+                self.on_expired(expired)
+            except Exception:  # pylint: disable=W0703
+                logging.exception("Error expiring tokens")
+
+class ChangeLog:
+    ''' Sequence-numbered changes applied to the users database
+
+    Changes are kept per origin replica and topic (see change_stream), up
+    to `max_size` each. `versions` holds the last sequence number applied
+    from every one of them.
+    '''
+    def __init__(self, max_size=CHANGE_LOG_SIZE):
+        self.max_size = max_size
+        self.entries = {}
+        self.versions = {}
+
+    def last(self, srv_id, kind):
+        """Last sequence number applied of the changes of `kind` from `srv_id`."""
+        return self.versions.get(change_stream(srv_id, kind), 0)
+
+    def append(self, change):
+        stream = change_stream(change.srvId, change.kind)
+        if stream not in self.entries:
+            self.entries[stream] = deque(maxlen=self.max_size)
+        self.entries[stream].append(change)
+        self.versions[stream] = change.seq
+
+    def since(self, version):
+        """Changes newer than `version`, None if some were already discarded."""
+        changes = []
+        for stream, last in self.versions.items():
+            known = version.get(stream, 0)
+            if known >= last:
+                continue
+            entries = self.entries.get(stream)
+            if not entries or entries[0].seq > known + 1:
+                return None
+            changes.extend(change for change in entries if change.seq > known)
+        return changes
+
+    def reset(self, version, own_id):
+        """Adopt the version of a snapshot, keeping the own changes."""
+        own_prefix = own_id + "/"
+        own_entries = {stream: entries for stream, entries in self.entries.items()
+                       if stream.startswith(own_prefix)}
+        own_versions = {stream: seq for stream, seq in self.versions.items()
+                        if stream.startswith(own_prefix)}
+        self.entries = own_entries
+        self.versions = dict(version)
+        for stream, seq in own_versions.items():
+            if seq > self.versions.get(stream, 0):
+                self.versions[stream] = seq
+
 class Authenticator(IceFlix.Authenticator):
     ''' Class authenticator'''
     def __init__(self) -> None:
         self.service_id = str(uuid.uuid4())
         self.user_tokens = {}
+        self.token_users = {}
+        self.token_expiry = {}
+        self.early_revocations = OrderedDict()
+        self.tokens_lock = threading.Lock()
+        self.expiry = TokenExpiryScheduler(self.remove_tokens)
+        self.token_key = None
         self.users_passwords = readJSON()
         self.servant_serv_announ = None
         self.updates_prx = None
         self.revocations_prx = None
-        self.is_updated = False
+        self.changelog = ChangeLog()
+        self.sync_lock = threading.RLock()
+        self.joined = False
+        self.syncing = False
+        self.pending = []
+        self.transfers = DataTransfers()
+        self.join_timeout = JOIN_TIMEOUT
+        self.join_timer = None
 
     def getMain(self):
         main_prx = random.choice(list(self.servant_serv_announ.mains.values()))
         return main_prx
 
     def share_data_with(self, service):
-        """Share the current database with an incoming service."""
-        db = IceFlix.UsersDB(self.users_passwords, self.user_tokens)
-        service.updateDB(db, self.service_id)
-
-    def remove_token(self, token, current=None):
-        iterator = iter(list(self.user_tokens.keys()))
-        while True:
-            try:
-                user = iterator.__next__()
-                if self.user_tokens[user] == token:
-                    del self.user_tokens[user]
-                    self.revocations_prx.revokeToken(token, self.service_id)
-            except StopIteration:
-                break
+        """The incoming service pulls our changes with getChangesSince."""
+
+    def authenticator_found(self, service):
+        """Join the replicas pulling the changes since the saved version from the first one found.
+
+        The replica is joined once a pull succeeds, if it fails the next
+        replica announced is tried.
+        """
+        with self.sync_lock:
+            if self.joined or self.syncing:
+                return
+            self.syncing = True
+            version = dict(self.changelog.versions)
+        self.sync_with(service, version)
+
+    def start_join_timer(self):
+        """Call join_alone after the join timeout."""
+        self.join_timer = threading.Timer(self.join_timeout, self.join_alone)
+        self.join_timer.daemon = True
+        self.join_timer.start()
+
+    def join_alone(self):
+        """Serve the own database if no replica shared theirs since the start.
+
+        Replicas only share their data once joined, so the first replicas of
+        a deployment would otherwise wait for each other forever.
+        """
+        with self.sync_lock:
+            if self.joined:
+                return
+            if self.syncing:
+                self.start_join_timer()
+                return
+            self.joined = True
+        logging.info("No replica to sync %s with, serving its own database", self.service_id)
+
+    def restore_state(self):
+        """Resume from the version vector and tokens saved by the previous run.
+
+        Tokens are expired again by this replica when the rest of their
+        lifetime ends, the ones that expired meanwhile are dropped.
+        """
+        state = readState()
+        if state is None:
+            return
+        now = time.time()
+        with self.sync_lock:
+            self.changelog.versions = {
+                stream: int(seq) for stream, seq in state["version"].items() if "/" in stream}
+            expiry = state.get("expiry", {})
+            live = {user: token for user, token in state["tokens"].items()
+                    if expiry.get(token, 0) > now}
+            self.set_tokens(live)
+            for token in live.values():
+                self.token_expiry[token] = expiry[token]
+                self.expiry.schedule(token, expiry[token] - now)
+        logging.info("Restored version of %d replicas and %d tokens",
+                     len(self.changelog.versions), len(self.user_tokens))
+
+    def save_state(self):
+        """Save the version vector and the live tokens for the next run."""
+        with self.sync_lock:
+            with self.tokens_lock:
+                user_tokens = dict(self.user_tokens)
+                expiry = {token: self.token_expiry[token] for token in user_tokens.values()}
+            state = {"version": dict(self.changelog.versions), "tokens": user_tokens,
+                     "expiry": expiry, "saved": time.time()}
+        try:
+            writeState(state)
+        except OSError:
+            error("Error al guardar el estado de sincronización")
+
+    def sync_with(self, service, version, tried=()):
+        """Pull the changes after `version` from another replica asynchronously.
+
+        If the pull fails it is retried with the other known replicas.
+        """
+        tried = set(tried) | {str(service)}
+        self.transfers.send(
+            service, "getChangesSince", (version, self.service_id),
+            lambda changes, exception: self.synced(changes, exception, service, version, tried))
+
+    def synced(self, changes, exception, service=None, version=None, tried=()):
+        """Apply the changes pulled by sync_with and the ones held meanwhile.
+
+        If the replica cannot be reached the pull is retried with the other
+        known replicas. If the changes held still do not follow the pulled
+        ones, a snapshot is pulled instead of applying them with a gap. Held
+        changes that do not follow a snapshot either wait for the missing
+        ones.
+        """
+        if exception is not None:
+            error("Error al sincronizar con otro autenticador")
+            others = [other for other in self.servant_serv_announ.authenticators.values()
+                      if str(other) not in tried]
+            with self.sync_lock:
+                if others:
+                    self.sync_with(random.choice(others), version, tried)
+                else:
+                    self.syncing = False
+            return
+        with self.sync_lock:
+            if changes.isSnapshot:
+                self.load_snapshot(changes.snapshot, changes.version)
+            for change in changes.changes:
+                self.apply_change(change)
+            self.joined = True
+            logging.info("Synced %s: %s with %d changes",
+                         self.service_id, "snapshot" if changes.isSnapshot else "delta",
+                         len(changes.changes))
+            if not self.apply_pending() and not changes.isSnapshot:
+                self.sync_with(service, {})
+                return
+            self.syncing = False
+        self.save_state()
+
+    def apply_pending(self):
+        """Apply the held changes that follow the applied ones.
+
+        Changes after a gap stay held, so the change log shared with other
+        replicas has no holes. Returns True if no change is left held.
+        """
+        with self.sync_lock:
+            held = []
+            for change in sorted(self.pending, key=lambda change: change.seq):
+                if change.seq > self.changelog.last(change.srvId, change.kind) + 1:
+                    held.append(change)
+                else:
+                    self.apply_change(change)
+            self.pending = held
+            return not held
+
+    def load_snapshot(self, snapshot, version):
+        """Replace the database with a snapshot from another replica."""
+        with self.sync_lock:
+            self.users_passwords = dict(snapshot.userPasswords)
+            writeJSON(self.users_passwords)
+            self.set_tokens(snapshot.usersToken)
+            self.changelog.reset(version, self.service_id)
+
+    def record_change(self, kind, user, value):
+        """Log a change made by this replica. Returns the context to publish it."""
+        with self.sync_lock:
+            seq = self.changelog.last(self.service_id, kind) + 1
+            self.changelog.append(IceFlix.UserChange(self.service_id, seq, kind, user, value))
+            return {"seq": str(seq)}
+
+    def apply_change(self, change):
+        """Apply a change from another replica unless it is already applied."""
+        with self.sync_lock:
+            if change.seq and change.seq <= self.changelog.last(change.srvId, change.kind):
+                return
+            if change.kind == IceFlix.UserChangeKind.UserAdded:
+                self.users_passwords[change.user] = change.value
+                writeJSON(self.users_passwords)
+            elif change.kind == IceFlix.UserChangeKind.UserRemoved:
+                self.users_passwords.pop(change.user, None)
+                writeJSON(self.users_passwords)
+            elif change.kind == IceFlix.UserChangeKind.TokenIssued:
+                if self.early_revocations.pop(change.value, None) is None:
+                    self.set_token(change.user, change.value)
+            elif change.kind == IceFlix.UserChangeKind.TokenRevoked:
+                if self.drop_token(change.value) is None:
+                    self.early_revocations[change.value] = True
+                    if len(self.early_revocations) > EARLY_REVOCATIONS_SIZE:
+                        self.early_revocations.popitem(last=False)
+            if change.seq:
+                self.changelog.append(change)
+
+    def receive_change(self, kind, user, value, srvId, context):
+        """Apply a change published by another replica.
+
+        Changes carry their sequence number for their topic in the "seq"
+        context entry. If some previous change of that replica and topic was
+        missed, this one is held and the missing ones are pulled from that
+        replica, or from another one if it is not known. With no replica
+        known the change stays held until a later change triggers a pull.
+        """
+        change = IceFlix.UserChange(srvId, int(context.get("seq", "0")), kind, user, value)
+        with self.sync_lock:
+            self.pending.append(change)
+            if self.syncing:
+                return
+            self.apply_pending()
+            if change not in self.pending:
+                return
+            authenticators = self.servant_serv_announ.authenticators
+            origin = authenticators.get(srvId)
+            if origin is None and authenticators:
+                origin = random.choice(list(authenticators.values()))
+            if origin is None:
+                return
+            self.syncing = True
+            self.sync_with(origin, dict(self.changelog.versions))
+
+    def getChangesSince(self, version, srvId, current=None):
+        with self.sync_lock:
+            if not self.joined:
+                raise IceFlix.TemporaryUnavailable()
+            changes = self.changelog.since(version) if version else None
+            current_version = dict(self.changelog.versions)
+            if changes is not None:
+                logging.info("Sending %d changes to %s", len(changes), srvId)
+                return IceFlix.UsersDBChanges(False, IceFlix.UsersDB({}, {}), current_version, changes)
+            with self.tokens_lock:
+                user_tokens = dict(self.user_tokens)
+            logging.info("Sending snapshot of %d users and %d tokens to %s",
+                         len(self.users_passwords), len(user_tokens), srvId)
+            snapshot = IceFlix.UsersDB(dict(self.users_passwords), user_tokens)
+            return IceFlix.UsersDBChanges(True, snapshot, current_version, [])
+
+    def set_token(self, user, token):
+        """Store the current token of a user. Returns the replaced one."""
+        with self.tokens_lock:
+            old_token = self.user_tokens.get(user)
+            if old_token is not None:
+                self.token_users.pop(old_token, None)
+                self.token_expiry.pop(old_token, None)
+            self.user_tokens[user] = token
+            self.token_users[token] = user
+            self.token_expiry[token] = time.time() + self.expiry.ttl
+            return old_token
+
+    def drop_token(self, token):
+        """Forget a token. Returns its user or None if it was not live."""
+        with self.tokens_lock:
+            user = self.token_users.pop(token, None)
+            self.token_expiry.pop(token, None)
+            if user is not None:
+                del self.user_tokens[user]
+            return user
+
+    def set_tokens(self, user_tokens):
+        """Replace every token with the given user -> token mapping."""
+        with self.tokens_lock:
+            self.user_tokens = dict(user_tokens)
+            self.token_users = {token: user for user, token in self.user_tokens.items()}
+            expires = time.time() + self.expiry.ttl
+            self.token_expiry = {token: self.token_expiry.get(token, expires)
+                                 for token in self.token_users}
+
+    def remove_tokens(self, tokens):
+        """Expire tokens and publish their revocations in one batch."""
+        revoked = []
+        with self.sync_lock:
+            for token in tokens:
+                user = self.drop_token(token)
+                if user is not None:
+                    context = self.record_change(IceFlix.UserChangeKind.TokenRevoked, user, token)
+                    revoked.append((token, context))
+        if not revoked:
+            return
+        try:
+            batch_prx = self.revocations_prx.ice_batchOneway()
+            for token, context in revoked:
+                batch_prx.revokeToken(token, self.service_id, context)
+            batch_prx.ice_flushBatchRequests()
+        except Ice.LocalException:
+            error("Error al publicar la revocación de tokens")
 
     def refreshAuthorization(self, user, passwordHash, current=None):
         if user in self.users_passwords.keys() and passwordHash == self.users_passwords[user]:
-            new_token = secrets.token_urlsafe(40)
-            self.user_tokens[user] = new_token
-            self.updates_prx.newToken(user, new_token, self.service_id)
-            timer = threading.Timer(120.0, self.remove_token, args=(new_token,))
-            timer.start()
+            if self.token_key:
+                new_token = issue_token(self.token_key, user, self.expiry.ttl)
+            else:
+                new_token = secrets.token_urlsafe(40)
+            with self.sync_lock:
+                old_token = self.set_token(user, new_token)
+                context = self.record_change(IceFlix.UserChangeKind.TokenIssued, user, new_token)
+            self.updates_prx.newToken(user, new_token, self.service_id, context)
+            self.expiry.schedule(new_token)
+            if old_token is not None:
+                # Verifiers of signed tokens and token caches only learn
+                # that the replaced token is no longer valid from here
+                self.expiry.cancel(old_token)
+                self.revocations_prx.revokeToken(old_token, self.service_id)
             return new_token
         raise IceFlix.Unauthorized()
 
     def isAuthorized(self, userToken, current=None):
-        for user in self.user_tokens.keys():
-            if userToken == self.user_tokens[user]:
-                return True
-        return False
+        return userToken in self.token_users
 
     def whois(self, userToken, current=None):
-        for user in self.user_tokens.keys():
-            if userToken == self.user_tokens[user]:
-                return user
-        raise IceFlix.Unauthorized()
+        try:
+            return self.token_users[userToken]
+        except KeyError:
+            raise IceFlix.Unauthorized()
+
+    def areAuthorized(self, userTokens, current=None):
+        token_users = self.token_users
+        return [token in token_users for token in userTokens]
+
+    def whoisMany(self, userTokens, current=None):
+        token_users = self.token_users
+        return [token_users.get(token, "") for token in userTokens]
 
     def addUser(self, user, passwordHash, adminToken, current=None):
         main_prx = self.getMain()
@@ -125,9 +559,11 @@ class Authenticator(IceFlix.Authenticator):
         except Exception:
             raise IceFlix.TemporaryUnavailable()
 
-        self.users_passwords[user] = passwordHash
-        writeJSON(self.users_passwords)
-        self.updates_prx.newUser(user, passwordHash, self.service_id)
+        with self.sync_lock:
+            self.users_passwords[user] = passwordHash
+            writeJSON(self.users_passwords)
+            context = self.record_change(IceFlix.UserChangeKind.UserAdded, user, passwordHash)
+        self.updates_prx.newUser(user, passwordHash, self.service_id, context)
 
     def removeUser(self, user, adminToken, current=None):
         main_prx = self.getMain()
@@ -139,17 +575,20 @@ class Authenticator(IceFlix.Authenticator):
         except Exception:
             raise IceFlix.TemporaryUnavailable()
 
-        del self.users_passwords[user]
-        writeJSON(self.users_passwords)
-        self.revocations_prx.revokeUser(user, self.service_id)
+        with self.sync_lock:
+            del self.users_passwords[user]
+            writeJSON(self.users_passwords)
+            context = self.record_change(IceFlix.UserChangeKind.UserRemoved, user, "")
+        context[REVOKED_AT_CONTEXT] = str(time.time_ns())
+        self.revocations_prx.revokeUser(user, self.service_id, context)
 
     def updateDB(self, currentDatabase, srvId, current=None):
         # if not srvId in self.servant_serv_announ.known_ids:
         #     raise IceFlix.UnknownService()
-        if not self.is_updated:
-            self.users_passwords = currentDatabase.userPasswords
-            self.user_tokens = currentDatabase.usersToken
-            self.is_updated = True
+        with self.sync_lock:
+            if not self.joined:
+                self.load_snapshot(currentDatabase, {})
+                self.joined = True
 
 class UserUpdates(IceFlix.UserUpdates):
     ''' Class to update users and tokens'''
@@ -159,12 +598,13 @@ class UserUpdates(IceFlix.UserUpdates):
 
     def newUser(self, user, passwordHash, srvId, current=None):
         if srvId in self.serv_subscriber.known_ids:
-            self.serv_auth.users_passwords[user] = passwordHash
-            writeJSON(self.serv_auth.users_passwords)
+            self.serv_auth.receive_change(
+                IceFlix.UserChangeKind.UserAdded, user, passwordHash, srvId, current.ctx)
 
     def newToken(self, user, userToken, srvId, current=None):
         if srvId in self.serv_subscriber.known_ids:
-            self.serv_auth.user_tokens[user] = userToken
+            self.serv_auth.receive_change(
+                IceFlix.UserChangeKind.TokenIssued, user, userToken, srvId, current.ctx)
 
 class Revocations(IceFlix.Revocations):
     ''' Class used to revocate tokens and users '''
@@ -174,15 +614,13 @@ class Revocations(IceFlix.Revocations):
 
     def revokeToken(self, userToken, srvId, current=None):
         if srvId in self.serv_subscriber.known_ids:
-            for user in self.serv_auth.user_tokens.keys():
-                if self.serv_auth.user_tokens[user] == userToken:
-                    del self.serv_auth.user_tokens[user]
-                    return
+            self.serv_auth.receive_change(
+                IceFlix.UserChangeKind.TokenRevoked, "", userToken, srvId, current.ctx)
 
     def revokeUser(self, user, srvId, current=None):
         if srvId in self.serv_subscriber.known_ids:
-            del self.serv_auth.users_passwords[user]
-            writeJSON(self.serv_auth.user_passwords)
+            self.serv_auth.receive_change(
+                IceFlix.UserChangeKind.UserRemoved, user, "", srvId, current.ctx)
 
 class AuthApp(Ice.Application):
     ''' Class used to authenticate'''
@@ -209,6 +647,7 @@ class AuthApp(Ice.Application):
             topic,
             self.servant.service_id,
             self.proxy,
+            self.servant.ice_staticId(),
         )
 
         self.subscriber = ServiceAnnouncementsListener(
@@ -217,11 +656,15 @@ class AuthApp(Ice.Application):
 
         subscriber_prx = self.adapter.addWithUUID(self.subscriber)
         topic.subscribeAndGetPublisher({}, subscriber_prx)
+        self.subscriber.start_checks()
 
     def run(self, args):
         broker = self.communicator()
         self.adapter = broker.createObjectAdapter("Authenticator")
         self.adapter.activate()
+        self.servant.expiry.ttl = float(broker.getProperties().getPropertyWithDefault(
+            "Authenticator.TokenTTL", str(TOKEN_TTL)))
+        self.servant.restore_state()
 
         #Subscriptions
         #User Updates
@@ -247,6 +690,9 @@ class AuthApp(Ice.Application):
         self.proxy = self.adapter.add(self.servant, broker.stringToIdentity("Authenticator"))
         self.setup_announcements()
         self.announcer.start_service()
+        self.servant.join_timeout = float(broker.getProperties().getPropertyWithDefault(
+            "Authenticator.JoinTimeout", str(JOIN_TIMEOUT)))
+        self.servant.start_join_timer()
 
 
         #Authenticator attributes
@@ -254,6 +700,10 @@ class AuthApp(Ice.Application):
         self.servant.servant_serv_announ = self.subscriber
         self.servant.revocations_prx = revocations_pub
         self.servant.updates_prx = user_updates_pub
+        self.servant.expiry.start()
+        self.servant.token_key = load_key(broker)
+        self.servant.changelog.max_size = broker.getProperties().getPropertyAsIntWithDefault(
+            "Authenticator.ChangeLogSize", CHANGE_LOG_SIZE)
 
         #User updates attributes
         servant_user_updates.serv_auth = self.servant
@@ -266,6 +716,10 @@ class AuthApp(Ice.Application):
         logging.info(self.proxy)
         self.shutdownOnInterrupt()
         broker.waitForShutdown()
+        self.subscriber.stop_checks()
+        logging.info("Data transfers: %s", self.servant.transfers.stats())
+        self.servant.expiry.stop()
+        self.servant.save_state()
         return 0
 
 if __name__ == "__main__":
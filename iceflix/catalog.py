@@ -13,6 +13,7 @@
 # pylint: disable=W1203
 # pylint: disable=W1514
 
+from collections import OrderedDict
 from datetime import datetime
 from distutils.log import error
 import logging
@@ -21,6 +22,8 @@ import random
 import os
 import sys
 import json
+import threading
+import time
 
 import Ice
 import IceStorm
@@ -31,9 +34,34 @@ except ImportError:
     Ice.loadSlice(os.path.join(os.path.dirname(__file__), "iceflix.ice"))
     import IceFlix
 from service_announcement import (
+    PING_TIMEOUT,
+    DataTransfers,
     ServiceAnnouncementsListener,
     ServiceAnnouncementsSender,
 )
+from auth_batching import (
+    AuthBatcher,
+    BATCH_WINDOW,
+    BATCH_WINDOW_PROPERTY,
+)
+from token_signing import (
+    REVOKED_AT_CONTEXT,
+    TokenVerifier,
+    load_key,
+)
+
+FLUSH_INTERVAL = 2.0
+NGRAM_SIZE = 3
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 30.0
+# Seconds between logs of the cache, transfer and provider stats, 0 disables them
+STATS_INTERVAL = 60.0
+# Seconds a successful ping to a provider is trusted, 0 pings it every time,
+# and seconds a provider that did not answer is skipped
+PROVIDER_HEALTH_TTL = 0.0
+PROVIDER_RETRY_INTERVAL = 10.0
+# Spare capacity assumed for the providers that do not announce it
+UNKNOWN_SPARE_CAPACITY = 1
 
 def getTopic(communicator, topic_name):
     """Method to create catalog topic."""
@@ -54,9 +82,7 @@ def createDB(service_id):
     msg = "Catalog " + service_id + " creating DB"
     logging.info(msg)
     dest_file = "./catalogDB/"+service_id+".json"
-    os.open(dest_file, os.O_CREAT | os.O_WRONLY)
-    db = open(dest_file, "w")
-    json.dump(data, db, indent=6)
+    writeDB(dest_file, data)
     return dest_file
 
 def removeDB(service_id):
@@ -65,8 +91,7 @@ def removeDB(service_id):
     logging.info(msg)
     dest_file = "./catalogDB/"+service_id + ".json"
     my_data = openDB(dest_file)
-    persistent_bd = open("./catalogDB/catalogDB.json", "w")
-    json.dump(my_data, persistent_bd, indent=6)
+    writeDB("./catalogDB/catalogDB.json", my_data)
     os.remove(dest_file)
 
 def openDB(path):
@@ -77,70 +102,495 @@ def openDB(path):
 
 def writeDB(path, data):
     """Writes new info to the database."""
-    db = open(path, "w")
-    json.dump(data, db, indent=6)
+    with open(path, "w") as db:
+        json.dump(data, db, indent=6)
 
-def checkMediaId(media_id, data):
+def ngrams(text):
+    """Return the set of n-grams of a text."""
+    return {text[pos:pos + NGRAM_SIZE] for pos in range(len(text) - NGRAM_SIZE + 1)}
+
+def checkMediaId(media_id, store):
     """Check if media id exist."""
-    if not media_id in data["info"].keys():
+    if not store.has_media(media_id):
         raise IceFlix.WrongMediaId(media_id)
 
-def addTagsList(data, user_name, media_id, tags):
-    """Appends tags to media."""
-    try:
-        current_tags = data["tags"][user_name][media_id]
-    except KeyError:
-        current_tags = []
-    new_tags = current_tags
-    for tag in tags:
-        if not tag in new_tags:
-            new_tags.append(tag)
-    return new_tags
-
-def removeTagsList(data, user_name, media_id, tags):
-    """Remove tags from media."""
-    current_tags = data["tags"][user_name][media_id]
-    new_tags = current_tags
-    for tag in tags:
-        if tag in new_tags:
-            new_tags.remove(tag)
-    return new_tags
+class CatalogStore:
+    """In-memory catalog database with write-behind persistence.
+
+    Reads are served from memory. Every change marks the store as dirty and
+    schedules a single flush after `flush_interval` seconds, so a burst of
+    writes ends up as one atomic rewrite of the JSON file.
+
+    Tag searches use a per-user inverted index (tag -> set of media ids).
+    `tag_order` keeps the position of every media in the user tags so the
+    results come out in the same order as a scan of the database.
+
+    Name searches use a hash map for exact names and a trigram index for
+    substrings. Index candidates are verified against the title and sorted by
+    `name_order`, which follows the insertion order of `info`.
+    """
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.info = {}
+        self.tags = {}
+        self.tag_index = {}
+        self.tag_order = {}
+        self.name_index = {}
+        self.ngram_index = {}
+        self.name_order = {}
+        self.name_seq = 0
+        self.lock = threading.RLock()
+        self.write_lock = threading.Lock()
+        self.dirty = False
+        self.timer = None
+        self.closed = False
+        self.load()
+
+    def load(self):
+        """Load the database file into memory."""
+        data = openDB(self.path)
+        with self.lock:
+            self.info = data.get("info", {})
+            self.tags = data.get("tags", {})
+            self.build_tag_index()
+            self.build_name_index()
+
+    def build_tag_index(self):
+        """Rebuild the per-user inverted tag index."""
+        with self.lock:
+            self.tag_index = {}
+            self.tag_order = {}
+            for user_name, user_tags in self.tags.items():
+                index = self.tag_index.setdefault(user_name, {})
+                order = self.tag_order.setdefault(user_name, {})
+                for media_id, media_tags in user_tags.items():
+                    order[media_id] = len(order)
+                    for tag in media_tags:
+                        index.setdefault(tag, set()).add(media_id)
+
+    def build_name_index(self):
+        """Rebuild the exact and trigram name indexes."""
+        with self.lock:
+            self.name_index = {}
+            self.ngram_index = {}
+            self.name_order = {}
+            self.name_seq = 0
+            for media_id, name in self.info.items():
+                self.index_name(media_id, name)
+
+    def index_name(self, media_id, name):
+        """Add a media name to the name indexes."""
+        if media_id not in self.name_order:
+            self.name_order[media_id] = self.name_seq
+            self.name_seq += 1
+        self.name_index.setdefault(name, set()).add(media_id)
+        for gram in ngrams(name):
+            self.ngram_index.setdefault(gram, set()).add(media_id)
+
+    def unindex_name(self, media_id, name):
+        """Remove a media name from the name indexes."""
+        self.name_index[name].discard(media_id)
+        if not self.name_index[name]:
+            del self.name_index[name]
+        for gram in ngrams(name):
+            self.ngram_index[gram].discard(media_id)
+            if not self.ngram_index[gram]:
+                del self.ngram_index[gram]
+
+    def media_by_name(self, name, exact):
+        """Return the media whose name is or contains the given one."""
+        with self.lock:
+            if exact:
+                ids = self.name_index.get(name, set())
+            elif len(name) < NGRAM_SIZE:
+                ids = [media_id for media_id, media_name in self.info.items()
+                       if name in media_name]
+            else:
+                postings = sorted((self.ngram_index.get(gram, set()) for gram in ngrams(name)),
+                                  key=len)
+                ids = [media_id for media_id in postings[0].intersection(*postings[1:])
+                       if name in self.info[media_id]]
+            return sorted(ids, key=self.name_order.get)
+
+    def to_dict(self):
+        """Return the database in its JSON layout."""
+        with self.lock:
+            return {"info": self.info, "tags": self.tags}
+
+    def has_media(self, media_id):
+        """Check if media id exist."""
+        with self.lock:
+            return media_id in self.info
+
+    def get_name(self, media_id):
+        """Return the name of a media, None if it does not exist."""
+        with self.lock:
+            return self.info.get(media_id)
+
+    def get_tags(self, user_name, media_id):
+        """Return the tags of a user for a media, if any."""
+        with self.lock:
+            return self.tags.get(user_name, {}).get(media_id)
+
+    def add_media(self, media_id, name):
+        """Add or replace a media entry."""
+        with self.lock:
+            if media_id in self.info:
+                self.unindex_name(media_id, self.info[media_id])
+            self.info[media_id] = name
+            self.index_name(media_id, name)
+            self.mark_dirty()
+
+    def remove_media(self, media_id):
+        """Remove a media entry."""
+        with self.lock:
+            if media_id not in self.info:
+                return
+            self.unindex_name(media_id, self.info.pop(media_id))
+            del self.name_order[media_id]
+            self.mark_dirty()
+
+    def rename(self, media_id, name):
+        """Change the name of a media, raise WrongMediaId if it does not exist."""
+        with self.lock:
+            if media_id not in self.info:
+                raise IceFlix.WrongMediaId(media_id)
+            self.unindex_name(media_id, self.info[media_id])
+            self.info[media_id] = name
+            self.index_name(media_id, name)
+            self.mark_dirty()
+
+    def add_tags(self, user_name, media_id, tags):
+        """Appends tags to media."""
+        with self.lock:
+            user_tags = self.tags.setdefault(user_name, {})
+            index = self.tag_index.setdefault(user_name, {})
+            if media_id not in user_tags:
+                order = self.tag_order.setdefault(user_name, {})
+                order[media_id] = len(order)
+            current_tags = user_tags.setdefault(media_id, [])
+            for tag in tags:
+                if not tag in current_tags:
+                    current_tags.append(tag)
+                    index.setdefault(tag, set()).add(media_id)
+            self.mark_dirty()
+
+    def remove_tags(self, user_name, media_id, tags):
+        """Remove tags from media."""
+        with self.lock:
+            current_tags = self.get_tags(user_name, media_id)
+            if current_tags is None:
+                return
+            index = self.tag_index.get(user_name, {})
+            for tag in tags:
+                if tag in current_tags:
+                    current_tags.remove(tag)
+                    if tag not in current_tags:
+                        index[tag].discard(media_id)
+                        if not index[tag]:
+                            del index[tag]
+            self.mark_dirty()
+
+    def replace(self, info, tags):
+        """Replace the whole database."""
+        with self.lock:
+            self.info = info
+            self.tags = tags
+            self.build_tag_index()
+            self.build_name_index()
+            self.mark_dirty()
+
+    def media_by_tags(self, user_name, tags, include_all_tags):
+        """Return the media of a user tagged with all or any of the tags."""
+        with self.lock:
+            index = self.tag_index.get(user_name, {})
+            order = self.tag_order.get(user_name, {})
+            if include_all_tags:
+                if not tags:
+                    return list(order)
+                postings = sorted((index.get(tag, set()) for tag in set(tags)), key=len)
+                ids = postings[0].intersection(*postings[1:])
+            else:
+                ids = set().union(*(index.get(tag, set()) for tag in tags))
+            return sorted(ids, key=order.get)
+
+    def mark_dirty(self):
+        """Schedule a flush if there is none pending."""
+        with self.lock:
+            self.dirty = True
+            if self.timer is None and not self.closed:
+                self.timer = threading.Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """Write the database to disk if it has changed."""
+        with self.write_lock:
+            with self.lock:
+                self.timer = None
+                if not self.dirty:
+                    return
+                content = json.dumps(self.to_dict(), indent=6)
+                self.dirty = False
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as db:
+                db.write(content)
+                db.flush()
+                os.fsync(db.fileno())
+            os.replace(tmp_path, self.path)
+
+    def close(self):
+        """Cancel the pending flush and write the last changes."""
+        with self.lock:
+            self.closed = True
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+        self.flush()
+
+class TokenCache:
+    """Bounded LRU cache of token -> user with a time to live.
+
+    Entries are also evicted as soon as a revocation for the token or the
+    user arrives. Every revocation increases `generation`: a user resolved
+    after a miss is only cached if no revocation arrived since the lookup,
+    otherwise a revoked token could be cached again as valid. `hits` and
+    `misses` count the lookups.
+    """
+    def __init__(self, max_size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.user_tokens = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+    def get(self, user_token):
+        """Return the cached user of a token or None."""
+        with self.lock:
+            entry = self.entries.get(user_token)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    self.remove(user_token)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(user_token)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, user_token, user_name, generation=None):
+        """Cache the user of a token, unless a revocation arrived after `generation`."""
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.remove(user_token)
+            self.entries[user_token] = (user_name, time.monotonic() + self.ttl)
+            self.user_tokens.setdefault(user_name, set()).add(user_token)
+            while len(self.entries) > self.max_size:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, user_token):
+        """Remove a token, the lock must be held."""
+        entry = self.entries.pop(user_token, None)
+        if entry is None:
+            return
+        tokens = self.user_tokens[entry[0]]
+        tokens.discard(user_token)
+        if not tokens:
+            del self.user_tokens[entry[0]]
+
+    def revoke_token(self, user_token):
+        """Evict a revoked token."""
+        with self.lock:
+            self.generation += 1
+            self.remove(user_token)
+
+    def revoke_user(self, user_name):
+        """Evict every token of a revoked user."""
+        with self.lock:
+            self.generation += 1
+            for user_token in list(self.user_tokens.get(user_name, ())):
+                self.remove(user_token)
+
+    def stats(self):
+        """Return a summary of the cache usage."""
+        lookups = self.hits + self.misses
+        ratio = self.hits / lookups if lookups else 0.0
+        return f"{len(self.entries)} tokens, {self.hits} hits, {self.misses} misses, {ratio:.1%} hit ratio"
+
+class MediaProviders:
+    """Set of stream providers holding every media, with their health and load.
+
+    The same media can be stored by several providers. The least loaded one,
+    the one announcing the most spare capacity, is chosen, with ties broken
+    at random so viewers of a popular media are spread across equally loaded
+    replicas. Providers that do not announce it are assumed to have
+    UNKNOWN_SPARE_CAPACITY and full providers are only chosen when no other
+    one answers. The chosen provider is pinged before it is returned, and
+    the next one is tried if it does not answer; one that does not answer
+    is skipped for `retry_interval` seconds. A successful ping can be
+    trusted for `health_ttl` seconds, at the risk of returning a provider
+    that died meanwhile.
+    """
+
+    def __init__(self, health_ttl=PROVIDER_HEALTH_TTL, retry_interval=PROVIDER_RETRY_INTERVAL):
+        self.health_ttl = health_ttl
+        self.retry_interval = retry_interval
+        self.providers = {}
+        self.healthy_until = {}
+        self.down_until = {}
+        self.listener = None
+        self.lock = threading.Lock()
+        self.failovers = 0
+
+    def add(self, media_id, service_id, provider):
+        """Register a provider of a media."""
+        with self.lock:
+            self.providers.setdefault(media_id, {})[service_id] = provider
+
+    def remove(self, media_id, service_id):
+        """Forget a provider of a media. Returns True if no provider is left."""
+        with self.lock:
+            media_providers = self.providers.get(media_id, {})
+            media_providers.pop(service_id, None)
+            if media_providers:
+                return False
+            self.providers.pop(media_id, None)
+            return True
+
+    def spare_capacity(self, service_id):
+        """Spare capacity announced by a provider, 0 if it is full."""
+        spare = self.listener.spare_capacity(service_id) if self.listener else None
+        if spare is None:
+            return UNKNOWN_SPARE_CAPACITY
+        return max(spare, 0)
+
+    def candidates(self, media_id):
+        """Return the (service_id, proxy) of the live providers of a media in trial order.
+
+        Providers evicted by the announcements listener are dropped.
+        """
+        now = time.monotonic()
+        with self.lock:
+            media_providers = self.providers.get(media_id, {})
+            if self.listener is not None:
+                for service_id in list(media_providers):
+                    if service_id not in self.listener.known_ids:
+                        del media_providers[service_id]
+            candidates = [
+                (service_id, provider) for service_id, provider in media_providers.items()
+                if self.down_until.get(service_id, 0) <= now
+            ]
+        ranked = [(self.spare_capacity(service_id), random.random(), service_id, provider)
+                  for service_id, provider in candidates]
+        ranked.sort(key=lambda candidate: candidate[:2], reverse=True)
+        return [(service_id, provider) for _, _, service_id, provider in ranked]
+
+    def alive(self, service_id, provider, checked=None):
+        """Check if a provider answers, pinging it unless it answered recently.
+
+        `checked` maps the providers already checked while serving the
+        current request to the result, so they are pinged once.
+        """
+        if checked is not None and service_id in checked:
+            return checked[service_id]
+        result = self.ping(service_id, provider)
+        if checked is not None:
+            checked[service_id] = result
+        return result
+
+    def ping(self, service_id, provider):
+        """Ping a provider unless it answered less than `health_ttl` seconds ago."""
+        now = time.monotonic()
+        if self.healthy_until.get(service_id, 0) > now:
+            return True
+        try:
+            provider.ice_invocationTimeout(PING_TIMEOUT).ice_ping()
+        except Ice.LocalException:
+            with self.lock:
+                self.healthy_until.pop(service_id, None)
+                self.down_until[service_id] = now + self.retry_interval
+            logging.warning(f"Stream provider {service_id} does not answer")
+            return False
+        with self.lock:
+            self.healthy_until[service_id] = now + self.health_ttl
+            self.down_until.pop(service_id, None)
+        return True
+
+    def best(self, media_id, checked=None):
+        """Return the proxy of the least loaded live provider of a media, None if there is none."""
+        for attempt, (service_id, provider) in enumerate(self.candidates(media_id)):
+            if self.alive(service_id, provider, checked):
+                if attempt:
+                    with self.lock:
+                        self.failovers += 1
+                return IceFlix.StreamProviderPrx.uncheckedCast(provider)
+        return None
+
+    def stats(self):
+        """Return a summary of the known providers."""
+        with self.lock:
+            replicas = sum(len(media_providers) for media_providers in self.providers.values())
+            down = sum(1 for until in self.down_until.values() if until > time.monotonic())
+            return (f"{len(self.providers)} media, {replicas} replicas, "
+                    f"{down} providers down, {self.failovers} failovers")
 
 class MediaCatalog(IceFlix.MediaCatalog):
     """MediaCatalog class."""
     def __init__(self):
-        self.media_providers = {}
+        self.media_providers = MediaProviders()
         self.service_id = str(uuid.uuid4())
         self.catalog_updates_prx = None
         self.servant_serv_announ = None
         self.announcer = None
         self.path_db = createDB(self.service_id)
+        self.store = CatalogStore(self.path_db)
+        self.token_cache = TokenCache()
+        self.verifier = TokenVerifier()
+        self.auth_batcher = AuthBatcher(self.getAuthenticator)
+        self.transfers = DataTransfers()
         self.is_updated = False
 
     def share_data_with(self, service):
         """Share the current database with an incoming service."""
-        data = openDB(self.path_db)
         media_list = []
-        for media_id in data["info"].keys():
-            tags_user = {}
-            for user in data["tags"].keys():
-                for id in data["tags"][user].keys():
-                    if id == media_id:
-                        tags_user[user] = data["tags"][user][id]
-            media = IceFlix.MediaDB(media_id, data["info"][media_id], tags_user)
-            media_list.append(media)
-        service.updateDB(media_list, self.service_id)
+        with self.store.lock:
+            for media_id, name in self.store.info.items():
+                tags_user = {}
+                for user, user_tags in self.store.tags.items():
+                    if media_id in user_tags:
+                        tags_user[user] = list(user_tags[media_id])
+                media_list.append(IceFlix.MediaDB(media_id, name, tags_user))
+        self.transfers.send(service, "updateDB", (media_list, self.service_id))
+
+    def getAuthenticator(self):
+        """Obtain an authenticator through a random main."""
+        main_prx = random.choice(list(self.servant_serv_announ.mains.values()))
+        return main_prx.getAuthenticator()
 
     def getUser(self, user_token, current=None):
         """Obtain the user."""
-        main_prx = random.choice(list(self.servant_serv_announ.mains.values()))
+        if self.verifier.accepts(user_token):
+            user_name = self.verifier.whois(user_token)
+            if user_name is None:
+                raise IceFlix.Unauthorized()
+            return user_name
+        user_name = self.token_cache.get(user_token)
+        if user_name is not None:
+            return user_name
+        generation = self.token_cache.generation
         try:
-            auth_prx = main_prx.getAuthenticator()
-            user_name = auth_prx.whois(user_token)
+            user_name = self.auth_batcher.whois(user_token)
         except IceFlix.TemporaryUnavailable:
             raise IceFlix.TemporaryUnavailable()
-        except IceFlix.Unauthorized:
+        if not user_name:
             raise IceFlix.Unauthorized()
+        self.token_cache.put(user_token, user_name, generation)
         return user_name
 
     def getTile(self, media_id, user_token, current=None):
@@ -155,48 +605,69 @@ class MediaCatalog(IceFlix.MediaCatalog):
                 raise IceFlix.Unauthorized()
 
         #Search media in DB
-        data = openDB(self.path_db)
-        try:
-            checkMediaId(media_id, data)
-        except IceFlix.WrongMediaId:
-            raise IceFlix.WrongMediaId(media_id)
-        media_name = data["info"][media_id]
+        with self.store.lock:
+            media_name = self.store.get_name(media_id)
+            if media_name is None:
+                raise IceFlix.WrongMediaId(media_id)
 
-        #Search tags
-        tags = [""]
-        if user_token:
-            try:
-                tags = data["tags"][user_name][media_id]
-            except KeyError:
-                tags = [""]
+            #Search tags
+            tags = [""]
+            if user_token:
+                tags = list(self.store.get_tags(user_name, media_id) or [""])
 
         #Search provider
-        try:
-            media_provider = self.media_providers[media_id]
-            media_provider = IceFlix.StreamProviderPrx.uncheckedCast(media_provider)
-            media_provider.ice_ping()
-        except Ice.LocalException:
-            self.media_providers[media_id] = None
+        media_provider = self.media_providers.best(media_id)
+        if media_provider is None:
             raise IceFlix.TemporaryUnavailable()
 
         #Objets creation
-        media_info = IceFlix.MediaInfo(media_name, tags)
+        media_info = IceFlix.MediaInfo(media_name, list(tags))
         media = IceFlix.Media(media_id, media_provider, media_info)
         return media
 
+    def getTiles(self, media_ids, user_token, current=None):
+        """Obtain several media resolving the user and each provider once."""
+        #Search user name
+        user_name = None
+        if user_token:
+            try:
+                user_name = self.getUser(user_token)
+            except IceFlix.TemporaryUnavailable:
+                raise IceFlix.TemporaryUnavailable()
+            except IceFlix.Unauthorized:
+                raise IceFlix.Unauthorized()
+
+        #Search media in DB
+        entries = []
+        with self.store.lock:
+            for media_id in media_ids:
+                if not self.store.has_media(media_id):
+                    entries.append((media_id, None, None))
+                    continue
+                tags = [""]
+                if user_name:
+                    tags = self.store.get_tags(user_name, media_id) or [""]
+                entries.append((media_id, self.store.get_name(media_id), list(tags)))
+
+        #Search providers
+        results = []
+        checked = {}
+        for media_id, media_name, tags in entries:
+            status = IceFlix.TileStatus.TileWrongMediaId
+            media = IceFlix.Media(media_id, None, IceFlix.MediaInfo("", []))
+            if media_name is not None:
+                status = IceFlix.TileStatus.TileUnavailable
+                media_provider = self.media_providers.best(media_id, checked)
+                if media_provider is not None:
+                    status = IceFlix.TileStatus.TileFound
+                    media = IceFlix.Media(
+                        media_id, media_provider, IceFlix.MediaInfo(media_name, tags))
+            results.append(IceFlix.TileResult(status, media))
+        return results
+
     def getTilesByName(self, name, exact, current=None):
         """Obtain media searching by name."""
-        data = openDB(self.path_db)
-        ids = []
-        if exact:
-            for media_id in data["info"].keys():
-                if name == data["info"][media_id]:
-                    ids.append(media_id)
-            return ids
-        for media_id in data["info"].keys():
-            if name in data["info"][media_id]:
-                ids.append(media_id)
-        return ids
+        return self.store.media_by_name(name, exact)
 
     def getTilesByTags(self, tags, include_all_tags, user_token, current=None):
         """Obtain media searching by tags."""
@@ -207,18 +678,7 @@ class MediaCatalog(IceFlix.MediaCatalog):
             raise IceFlix.Unauthorized()
 
         #Get tags
-        data = openDB(self.path_db)
-        tags_user = data["tags"][user_name]
-        ids = []
-        if include_all_tags:
-            for media_id in tags_user.keys():
-                if all(elem in tags_user[media_id] for elem in tags):
-                    ids.append(media_id)
-            return ids
-        for media_id in tags_user.keys():
-            if any(elem in tags_user[media_id] for elem in tags):
-                ids.append(media_id)
-        return ids
+        return self.store.media_by_tags(user_name, tags, include_all_tags)
 
     def addTags(self, media_id, tags, user_token, current=None):
         """Add tags to specific media."""
@@ -229,22 +689,13 @@ class MediaCatalog(IceFlix.MediaCatalog):
             raise IceFlix.Unauthorized()
 
         #Search medio
-        data = openDB(self.path_db)
         try:
-            checkMediaId(media_id, data)
+            checkMediaId(media_id, self.store)
         except IceFlix.WrongMediaId:
             raise IceFlix.WrongMediaId(media_id)
 
-        #Get tags
-        new_tags = addTagsList(data, user_name, media_id, tags)
         #Set tags
-        try:
-            data["tags"][user_name][media_id] = new_tags
-        except KeyError:
-            data["tags"][user_name] = {}
-            data["tags"][user_name][media_id] = new_tags
-
-        writeDB(self.path_db, data)
+        self.store.add_tags(user_name, media_id, tags)
         self.catalog_updates_prx.addTags(media_id, tags, user_name, self.service_id)
 
     def removeTags(self, media_id, tags, user_token, current=None):
@@ -256,16 +707,13 @@ class MediaCatalog(IceFlix.MediaCatalog):
             raise IceFlix.Unauthorized()
 
         #Search medio
-        data = openDB(self.path_db)
         try:
-            checkMediaId(media_id, data)
+            checkMediaId(media_id, self.store)
         except IceFlix.WrongMediaId:
             raise IceFlix.WrongMediaId(media_id)
 
-        #Get tags
-        new_tags = removeTagsList(data, user_name, media_id, tags)
-        data["tags"][user_name][media_id] = new_tags
-        writeDB(self.path_db, data)
+        #Set tags
+        self.store.remove_tags(user_name, media_id, tags)
         self.catalog_updates_prx.removeTags(media_id, tags, user_name, self.service_id)
 
     def renameTile(self, media_id, name, admin_token, current=None):
@@ -281,14 +729,12 @@ class MediaCatalog(IceFlix.MediaCatalog):
             raise IceFlix.Unauthorized()
 
         #Search medio
-        data = openDB(self.path_db)
         try:
-            checkMediaId(media_id, data)
+            checkMediaId(media_id, self.store)
         except IceFlix.WrongMediaId:
             raise IceFlix.WrongMediaId(media_id)
 
-        data["info"][media_id] = name
-        writeDB(self.path_db, data)
+        self.store.rename(media_id, name)
         self.catalog_updates_prx.renameTile(media_id, name, self.service_id)
 
     def updateDB(self, catalog_database, service_id, current=None):
@@ -296,19 +742,14 @@ class MediaCatalog(IceFlix.MediaCatalog):
         # if not service_id in self.servant_serv_announ.known_ids:
         #     raise IceFlix.UnknownService()
         if not self.is_updated:
-            data = {}
-            data["info"] = {}
-            data["tags"] = {}
-
+            info = {}
+            tags = {}
             for media_db in catalog_database:
-                data["info"][media_db.mediaId] = media_db.name
+                info[media_db.mediaId] = media_db.name
                 for user in media_db.tagsPerUser.keys():
-                    try:
-                        data["tags"][user][media_db.mediaId] = media_db.tagsPerUser[user]
-                    except KeyError:
-                        data["tags"][user] = {}
+                    tags.setdefault(user, {})[media_db.mediaId] = list(media_db.tagsPerUser[user])
 
-            writeDB(self.path_db, data)
+            self.store.replace(info, tags)
             self.is_updated = True
 
 class CatalogUpdates(IceFlix.CatalogUpdates):
@@ -316,50 +757,44 @@ class CatalogUpdates(IceFlix.CatalogUpdates):
     def __init__(self) -> None:
         self.servant_serv_announ = None
         self.servant = None
+
+    def is_remote(self, service_id):
+        """Check if the update comes from another known catalog."""
+        return service_id in self.servant_serv_announ.known_ids and service_id != self.servant.service_id
+
     def renameTile(self, media_id, name, service_id, current=None):
         """This method is used to change the name of specific media."""
         #Check service
-        data = {}
-        if service_id in self.servant_serv_announ.known_ids and service_id != self.servant.service_id:
-            data = openDB(self.servant.path_db)
+        if not self.is_remote(service_id):
+            return
         try:
-            checkMediaId(media_id, data)
+            checkMediaId(media_id, self.servant.store)
         except IceFlix.WrongMediaId:
             raise IceFlix.WrongMediaId(media_id)
 
-        data["info"][media_id] = name
-        db = open(self.servant.path_db, "w")
-        json.dump(data, db, indent=6)
+        self.servant.store.rename(media_id, name)
 
     def addTags(self, media_id, tags, user, service_id, current=None):
         """Add tags to specific media."""
-        if service_id in self.servant_serv_announ.known_ids and service_id != self.servant.service_id:
-            data = openDB(self.servant.path_db)
+        if not self.is_remote(service_id):
+            return
         try:
-            checkMediaId(media_id, data)
+            checkMediaId(media_id, self.servant.store)
         except IceFlix.WrongMediaId:
             raise IceFlix.WrongMediaId(media_id)
 
-        new_tags = addTagsList(data, user, media_id, tags)
-
-        #Set tags
-        data["tags"][user][media_id] = new_tags
-        writeDB(self.servant.path_db, data)
+        self.servant.store.add_tags(user, media_id, tags)
 
     def removeTags(self, media_id, tags, user, service_id, current=None):
         """Remove tags from specific media."""
-        if service_id in self.servant_serv_announ.known_ids and service_id != self.servant.service_id:
-            data = openDB(self.servant.path_db)
+        if not self.is_remote(service_id):
+            return
         try:
-            checkMediaId(media_id, data)
+            checkMediaId(media_id, self.servant.store)
         except IceFlix.WrongMediaId:
             raise IceFlix.WrongMediaId(media_id)
 
-        #Get tags
-        new_tags = removeTagsList(data, user, media_id, tags)
-
-        data["tags"][user][media_id] = new_tags
-        writeDB(self.servant.path_db, data)
+        self.servant.store.remove_tags(user, media_id, tags)
 
 class StreamAnnouncements(IceFlix.StreamAnnouncements):
     """StreamAnnouncements class."""
@@ -371,19 +806,33 @@ class StreamAnnouncements(IceFlix.StreamAnnouncements):
         """Method that updates database when uploading new media."""
         if service_id in self.servant_serv_announ.known_ids:
             logging.info(f"Receiving {initial_name}")
-            data = openDB(self.servant.path_db)
-            data["info"][media_id] = initial_name
-            self.servant.media_providers[media_id] = self.servant_serv_announ.providers[service_id]
-            writeDB(self.servant.path_db, data)
+            if not self.servant.store.has_media(media_id):
+                self.servant.store.add_media(media_id, initial_name)
+            self.servant.media_providers.add(
+                media_id, service_id, self.servant_serv_announ.providers[service_id])
 
     def removedMedia(self, media_id, service_id, current=None):
         """Method that updates database when removing media."""
         if service_id in self.servant_serv_announ.known_ids:
             logging.info(f"Deleting {service_id}")
-            data = openDB(self.servant.path_db)
-            del data["info"][media_id]
-            del self.servant.media_providers[media_id]
-            writeDB(self.servant.path_db, data)
+            if self.servant.media_providers.remove(media_id, service_id):
+                self.servant.store.remove_media(media_id)
+
+class Revocations(IceFlix.Revocations):
+    """Revocations class, keeps the token cache and the signed token deny list up to date."""
+    def __init__(self):
+        self.servant = None
+
+    def revokeToken(self, user_token, service_id, current=None):
+        """Method used to evict a revoked token."""
+        self.servant.token_cache.revoke_token(user_token)
+        self.servant.verifier.revoke_token(user_token)
+
+    def revokeUser(self, user, service_id, current=None):
+        """Method used to evict the tokens of a removed user."""
+        self.servant.token_cache.revoke_user(user)
+        self.servant.verifier.revoke_user(
+            user, current.ctx.get(REVOKED_AT_CONTEXT) if current else None)
 
 class CatalogApp(Ice.Application):
     """CatalogApp class."""
@@ -393,6 +842,18 @@ class CatalogApp(Ice.Application):
         self.proxy = None
         self.announcer = None
         self.subscriber = None
+        self.stats_stopped = threading.Event()
+
+    def log_stats(self):
+        """Log the usage of the token cache, the data transfers and the providers."""
+        logging.info("Token cache: %s", self.servant.token_cache.stats())
+        logging.info("Data transfers: %s", self.servant.transfers.stats())
+        logging.info("Media providers: %s", self.servant.media_providers.stats())
+
+    def run_stats(self, interval):
+        """Log the stats every `interval` seconds until stopped."""
+        while not self.stats_stopped.wait(interval):
+            self.log_stats()
 
     def setup_announcements(self):
         """Configure the announcements sender and listener."""
@@ -411,6 +872,7 @@ class CatalogApp(Ice.Application):
             topic,
             self.servant.service_id,
             self.proxy,
+            self.servant.ice_staticId(),
         )
 
         self.subscriber = ServiceAnnouncementsListener(
@@ -419,12 +881,27 @@ class CatalogApp(Ice.Application):
 
         subscriber_prx = self.adapter.addWithUUID(self.subscriber)
         topic.subscribeAndGetPublisher({}, subscriber_prx)
+        self.subscriber.start_checks()
 
     def run(self, args):
         """Initialization of catalog."""
         broker = self.communicator()
         self.adapter = broker.createObjectAdapter("Catalog")
         self.adapter.activate()
+        properties = broker.getProperties()
+        self.servant.store.flush_interval = float(
+            properties.getPropertyWithDefault("Catalog.FlushInterval", str(FLUSH_INTERVAL)))
+        self.servant.token_cache.max_size = properties.getPropertyAsIntWithDefault(
+            "Catalog.TokenCacheSize", TOKEN_CACHE_SIZE)
+        self.servant.token_cache.ttl = float(
+            properties.getPropertyWithDefault("Catalog.TokenCacheTTL", str(TOKEN_CACHE_TTL)))
+        self.servant.media_providers.health_ttl = float(properties.getPropertyWithDefault(
+            "Catalog.ProviderHealthTTL", str(PROVIDER_HEALTH_TTL)))
+        self.servant.media_providers.retry_interval = float(properties.getPropertyWithDefault(
+            "Catalog.ProviderRetryInterval", str(PROVIDER_RETRY_INTERVAL)))
+        self.servant.verifier.key = load_key(broker)
+        self.servant.auth_batcher.window = float(
+            properties.getPropertyWithDefault(BATCH_WINDOW_PROPERTY, str(BATCH_WINDOW)))
 
         #Subscriptions
         #StreamAnnouncements
@@ -442,6 +919,13 @@ class CatalogApp(Ice.Application):
         catalog_updates_pub = catalog_updates_topic.getPublisher()
         catalog_updates_pub = IceFlix.CatalogUpdatesPrx.uncheckedCast(catalog_updates_pub)
 
+        #Revocations
+        revocations_topic = getTopic(broker, "Revocations")
+        servant_revocations = Revocations()
+        servant_revocations.servant = self.servant
+        revocations_prx = self.adapter.addWithUUID(servant_revocations)
+        revocations_topic.subscribeAndGetPublisher({}, revocations_prx)
+
         #Service Announcements
         self.proxy = self.adapter.add(self.servant, broker.stringToIdentity("MediaCatalog"))
         self.setup_announcements()
@@ -450,6 +934,7 @@ class CatalogApp(Ice.Application):
 
         self.servant.catalog_updates_prx = catalog_updates_pub
         self.servant.servant_serv_announ = self.subscriber
+        self.servant.media_providers.listener = self.subscriber
         self.servant.announcer = self.announcer
 
         servant_catalog_updates.servant = self.servant
@@ -459,9 +944,18 @@ class CatalogApp(Ice.Application):
         servant_stream_announ.servant = self.servant
         servant_stream_announ.servant_serv_announ = self.subscriber
 
+        stats_interval = float(
+            properties.getPropertyWithDefault("Catalog.StatsInterval", str(STATS_INTERVAL)))
+        if stats_interval > 0:
+            threading.Thread(target=self.run_stats, args=(stats_interval,), daemon=True).start()
+
         logging.info(self.proxy)
         self.shutdownOnInterrupt()
         broker.waitForShutdown()
+        self.subscriber.stop_checks()
+        self.stats_stopped.set()
+        self.log_stats()
+        self.servant.store.close()
         removeDB(self.servant.service_id)
 
         return 0
@@ -22,6 +22,7 @@ import os
 import sys
 import time
 import getpass
+import threading
 import hashlib
 
 import Ice
@@ -39,6 +40,9 @@ except ImportError:
     import IceFlix
 
 RECONNECTION_ATTEMPTS = 3
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# Seconds between keepAlive calls, below the stream lease of the providers
+KEEPALIVE_INTERVAL = 20.0
 
 
 class StreamSync(IceFlix.StreamSync):
@@ -47,9 +51,19 @@ class StreamSync(IceFlix.StreamSync):
         self.stream_controller_prx = stream_controller_prx
         self.client = client
     def requestAuthentication(self, current=None):
-        """Used to request Authtentication to client."""
+        """Used to request Authtentication to client.
+
+        The request can arrive before the revocation of the token, so a
+        token the authenticator no longer accepts is renewed first.
+        """
         try:
-            self.stream_controller_prx.refreshAuthentication(self.client.user["token"])
+            token = self.client.user["token"]
+            auth_prx = self.client.main_prx.getAuthenticator()
+            if not auth_prx.isAuthorized(token):
+                token = self.client.renewToken(token)
+            self.stream_controller_prx.refreshAuthentication(token)
+        except IceFlix.TemporaryUnavailable:
+            error("Servicio de autenticación no disponible")
         except IceFlix.Unauthorized:
             error("Token incorrecto")
 
@@ -61,9 +75,7 @@ class Revocations(IceFlix.Revocations):
         """Method used to revoke user token."""
         if self.client.user["token"] == userToken:
             try:
-                auth_prx = self.client_main_prx.getAuthenticator()
-                self.client.user["token"] = auth_prx.refreshAuthentication(
-                    self.client.user["user"], self.client.user["pass_encoded"])
+                self.client.renewToken(userToken)
             except IceFlix.TemporaryUnavailable:
                 error("Servicio de autenticación no disponible")
             except IceFlix.Unauthorized:
@@ -97,6 +109,17 @@ class ClientApp(Ice.Application):
         self.user = {"token":"", "user": "", "pass_encoded":""}
         self.player = None
         self.stream_controller_prx = None
+        self.keepalive = None
+        self.token_lock = threading.Lock()
+
+    def renewToken(self, revoked_token):
+        """Log in again if the token is still `revoked_token` and return the token."""
+        with self.token_lock:
+            if self.user["token"] == revoked_token:
+                auth_prx = self.main_prx.getAuthenticator()
+                self.user["token"] = auth_prx.refreshAuthorization(
+                    self.user["user"], self.user["pass_encoded"])
+            return self.user["token"]
 
     def selectMedia(self):
         """Media selector by keyboard"""
@@ -132,7 +155,18 @@ class ClientApp(Ice.Application):
                 media.mediaId, self.user["token"])
         except AttributeError:
             error("Servicio de streaming no disponible")
-        uri = self.stream_controller_prx.getSDP(self.user["token"], 8080)
+        except IceFlix.TemporaryUnavailable:
+            error("El servidor de streaming no admite más reproducciones")
+            return
+        try:
+            uri = self.stream_controller_prx.getSDP(self.user["token"], 8080)
+        except IceFlix.TemporaryUnavailable:
+            error("El servidor de streaming está saturado")
+            return
+        self.keepalive = threading.Event()
+        threading.Thread(target=self.keepStreamAlive,
+                         args=(self.stream_controller_prx, self.keepalive),
+                         daemon=True).start()
         servant_stream_sync = StreamSync(self.stream_controller_prx, self)
         sync_topic = self.getTopic("StreamSync")
         sync_prx = self.adapter.addWithUUID(servant_stream_sync)
@@ -143,6 +177,15 @@ class ClientApp(Ice.Application):
         self.player.play(uri)
         logging.info("Reproduciendo medio " + media.info.name)
 
+    def keepStreamAlive(self, stream_controller_prx, stopped):
+        """Renew the lease of a stream until it is stopped."""
+        while not stopped.wait(KEEPALIVE_INTERVAL):
+            try:
+                stream_controller_prx.keepAlive()
+            except Ice.LocalException:
+                error("Error de conexión con el servidor de StreamController")
+                return
+
     def edit_tags(self, catalog_prx, media):
         """This method is used to change the tags of specific media."""
         selection = self.num_question(
@@ -181,11 +224,15 @@ class ClientApp(Ice.Application):
         """Obtain media searching by id."""
         media = []
         try:
-            for id in ids_media:
-                media.append(catalog_prx.getTile(id, self.user["token"]))
+            tiles = catalog_prx.getTiles(ids_media, self.user["token"])
+            for tile in tiles:
+                if tile.status == IceFlix.TileStatus.TileFound:
+                    media.append(tile.media)
+                elif tile.status == IceFlix.TileStatus.TileWrongMediaId:
+                    error(f"El id del medio no es correcto: {tile.media.mediaId}")
+                else:
+                    error(f"El medio {tile.media.mediaId} no está disponible")
             return media
-        except IceFlix.WrongMediaId:
-            error("El id del medio no es correcto")
         except IceFlix.TemporaryUnavailable:
             error("El servicio de catálogo o algún medio no están disponibles")
         except IceFlix.Unauthorized:
@@ -307,14 +354,11 @@ class ClientApp(Ice.Application):
         """Admin menu option 4: Upload media."""
         old_path, new_path = self.selectMedia()
         if old_path and new_path:
-            servant_uploader = MediaUploader(old_path)
-            uploader_prx = self.adapter.addWithUUID(servant_uploader)
-            uploader_prx = IceFlix.MediaUploaderPrx.checkedCast(uploader_prx)
             stream_provider_prx_str = input("Introduzca un proxy válido de Stream Provider: ")
             stream_provider_prx = self.broker.stringToProxy(stream_provider_prx_str)
             stream_provider_prx = IceFlix.StreamProviderPrx.uncheckedCast(stream_provider_prx)
             try:
-                stream_provider_prx.uploadMedia(old_path, uploader_prx, self.admin_token)
+                self.uploadMedia(stream_provider_prx, old_path)
                 logging.info("Medio subido con éxito")
             except IceFlix.UploadError:
                 logging.error("Error al subir el medio")
@@ -324,6 +368,41 @@ class ClientApp(Ice.Application):
             except Ice.LocalException:
                 error("El servidor de streaming no se encuentra disponible")
 
+    def uploadMedia(self, stream_provider_prx, path):
+        """Upload a file in a resumable session and return its media id.
+
+        Failed writes are retried from the offset stored by the provider.
+        """
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as media_file:
+            for chunk in iter(lambda: media_file.read(UPLOAD_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+        size = os.path.getsize(path)
+        state = stream_provider_prx.beginUpload(path, size, sha256.hexdigest(), self.admin_token)
+        if state.mediaId:
+            logging.info("El medio ya estaba almacenado")
+            return state.mediaId
+        offset = state.offset
+        attempts = 0
+        with open(path, "rb") as media_file:
+            while offset is None or offset < size:
+                try:
+                    if offset is None:
+                        offset = stream_provider_prx.queryUpload(state.sessionId)
+                        continue
+                    media_file.seek(offset)
+                    chunk = media_file.read(UPLOAD_CHUNK_SIZE)
+                    offset = stream_provider_prx.writeUpload(state.sessionId, offset, chunk)
+                    attempts = 0
+                except Ice.LocalException:
+                    attempts += 1
+                    if attempts > RECONNECTION_ATTEMPTS:
+                        raise
+                    error("Error al subir el medio, reintentando")
+                    time.sleep(1)
+                    offset = None
+        return stream_provider_prx.commitUpload(state.sessionId)
+
     def admin5(self):
         """Admin menu option 5: Delete media."""
         print("Busque por nombre el medio que desea eliminar")
@@ -448,6 +527,8 @@ class ClientApp(Ice.Application):
         else:
             self.player.stop()
             self.player = None
+            if self.keepalive:
+                self.keepalive.set()
             try:
                 self.stream_controller_prx.stop()
             except Ice.LocalException:
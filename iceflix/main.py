@@ -9,7 +9,6 @@
 from distutils.log import error
 import logging
 import uuid
-import random
 import os
 import sys
 
@@ -22,9 +21,16 @@ except ImportError:
     Ice.loadSlice(os.path.join(os.path.dirname(__file__), "iceflix.ice"))
     import IceFlix
 from service_announcement import (
+    DataTransfers,
     ServiceAnnouncementsListener,
     ServiceAnnouncementsSender,
 )
+from replica_selection import (
+    CHECK_INTERVAL,
+    DEFAULT_POLICY,
+    POLICIES,
+    ReplicaSelector,
+)
 logging.basicConfig(level=logging.INFO)
 MY_ADMIN_TOKEN = "admin"
 APP = None
@@ -38,34 +44,31 @@ class Main(IceFlix.Main):
         """Create the Main servant instance."""
         self.service_id = str(uuid.uuid4())
         self.is_updated = False
+        self.authenticators = ReplicaSelector(lambda: APP.subscriber.authenticators)
+        self.catalogs = ReplicaSelector(lambda: APP.subscriber.catalogs)
+        self.transfers = DataTransfers()
 
     def share_data_with(self, service):
         """Share the current database with an incoming service."""
-        service.updateDB(None, self.service_id)
+        current_services = IceFlix.VolatileServices(
+            list(APP.subscriber.authenticators.values()),
+            list(APP.subscriber.catalogs.values()),
+        )
+        self.transfers.send(service, "updateDB", (current_services, self.service_id))
 
     def getAuthenticator(self, current=None):
         """ Returns a valid authenticator proxy"""
-        if len(APP.subscriber.authenticators.keys()) < 1:
-            raise IceFlix.TemporaryUnavailable()
-        key = random.choice(list(APP.subscriber.authenticators.keys()))
-        prx_auth = APP.subscriber.authenticators[key]
-        try:
-            prx_auth.ice_ping()
-            return prx_auth
-        except Ice.LocalException:
+        prx_auth = self.authenticators.select()
+        if prx_auth is None:
             raise IceFlix.TemporaryUnavailable()
+        return prx_auth
 
     def getCatalog(self, current=None):
         """ Returns a valid catalog proxy"""
-        if len(APP.subscriber.catalogs.keys()) < 1:
-            raise IceFlix.TemporaryUnavailable()
-        key = random.choice(list(APP.subscriber.catalogs.keys()))
-        prx_catalog = APP.subscriber.catalogs[key]
-        try:
-            prx_catalog.ice_ping()
-            return prx_catalog
-        except Ice.LocalException:
+        prx_catalog = self.catalogs.select()
+        if prx_catalog is None:
             raise IceFlix.TemporaryUnavailable()
+        return prx_catalog
 
     def updateDB(self, currentServices, service_id, current=None):  # pylint: disable=invalid-name,unused-argument
         """Receives the current main service database from a peer."""
@@ -74,9 +77,13 @@ class Main(IceFlix.Main):
         )
         if not self.is_updated:
             for auth in currentServices.authenticators:
-                APP.subscriber.authenticators.append(auth)
+                if auth not in APP.subscriber.authenticators.values():
+                    APP.subscriber.register(
+                        str(auth), auth, IceFlix.AuthenticatorPrx.ice_staticId())
             for catalog in currentServices.mediaCatalogs:
-                APP.subscriber.catalogs.append(catalog)
+                if catalog not in APP.subscriber.catalogs.values():
+                    APP.subscriber.register(
+                        str(catalog), catalog, IceFlix.MediaCatalogPrx.ice_staticId())
             self.is_updated = True
 
     def isAdmin(self, adminToken, current=None):
@@ -118,6 +125,7 @@ class MainApp(Ice.Application):
             topic,
             self.servant.service_id,
             self.proxy,
+            self.servant.ice_staticId(),
         )
 
         self.subscriber = ServiceAnnouncementsListener(
@@ -126,6 +134,7 @@ class MainApp(Ice.Application):
 
         subscriber_prx = self.adapter.addWithUUID(self.subscriber)
         topic.subscribeAndGetPublisher({}, subscriber_prx)
+        self.subscriber.start_checks()
 
     def check_token(self, argv):
         """Check if the given token is the admin one"""
@@ -157,10 +166,26 @@ class MainApp(Ice.Application):
         self.setup_announcements()
         self.announcer.start_service()
 
+        properties = comm.getProperties()
+        policy = properties.getPropertyWithDefault("Main.SelectionPolicy", DEFAULT_POLICY)
+        if policy not in POLICIES:
+            error("Unknown selection policy " + policy)
+            policy = DEFAULT_POLICY
+        interval = float(properties.getPropertyWithDefault(
+            "Main.HealthCheckInterval", str(CHECK_INTERVAL)))
+        for selector in (self.servant.authenticators, self.servant.catalogs):
+            selector.policy = policy
+            selector.interval = interval
+            selector.start()
+
         self.shutdownOnInterrupt()
         comm.waitForShutdown()
 
         self.announcer.stop()
+        self.subscriber.stop_checks()
+        logging.info("Data transfers: %s", self.servant.transfers.stats())
+        self.servant.authenticators.stop()
+        self.servant.catalogs.stop()
 
         return 0
 
@@ -0,0 +1,277 @@
+"""Module for computing media ids without loading whole files in memory.
+
+Media ids are the SHA-256 of `str(content)`, the Python representation of
+the file bytes, as computed by the first versions of the stream provider.
+`media_id` produces exactly the same ids reading the file through mmap in
+fixed-size chunks, so existing catalogs keep working and no migration is
+needed. The representation escapes every byte on its own, so it can be
+hashed chunk by chunk (see `MediaHasher`).
+
+A `MediaManifest` persists the id and the SHA-256 of the content of every
+file together with its size, modification time and inode, so unchanged
+files are never hashed again and files with the same content are found
+without reading them. Entries written before the content hash was stored
+are treated as missing, so each of those files is hashed once again.
+A `MediaScanner` hashes the rest in a pool of worker processes and reports
+every id as soon as it is known.
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+CHUNK_SIZE = 1 << 20
+MANIFEST_PATH = "media_manifest.json"
+MANIFEST_PATH_PROPERTY = "StreamProvider.ManifestPath"
+SCAN_WORKERS_PROPERTY = "StreamProvider.ScanWorkers"
+PROGRESS_INTERVAL = 5.0
+
+
+class MediaHasher:
+    """Computes a media id from consecutive chunks of content.
+
+    repr() uses double quotes only when the bytes contain a single quote and
+    no double quote, and the quote changes how single quotes are escaped.
+    Until a double quote shows up both representations are hashed, the right
+    one is chosen at the end. Chunks are escaped by repr() itself with a
+    prefix that forces the quote, the prefix is sliced away afterwards.
+    """
+
+    def __init__(self):
+        self.single = hashlib.sha256(b"b'")
+        self.double = hashlib.sha256(b'b"')
+        self.content = hashlib.sha256()
+        self.has_single_quote = False
+        self.size = 0
+
+    def update(self, chunk):
+        """Add the next chunk of content."""
+        self.size += len(chunk)
+        self.content.update(chunk)
+        if self.double is not None:
+            if b'"' in chunk:
+                self.double = None
+            else:
+                self.double.update(repr(b"'" + chunk)[3:-1].encode())
+        if not self.has_single_quote:
+            self.has_single_quote = b"'" in chunk
+        self.single.update(repr(b"'\"" + chunk)[5:-1].encode())
+
+    def hexdigest(self):
+        """Return the media id of the content added so far."""
+        if self.has_single_quote and self.double is not None:
+            digest = self.double.copy()
+            digest.update(b'"')
+        else:
+            digest = self.single.copy()
+            digest.update(b"'")
+        return digest.hexdigest()
+
+    def sha256(self):
+        """Return the SHA-256 of the content added so far."""
+        return self.content.hexdigest()
+
+
+def media_digests(path, chunk_size=CHUNK_SIZE):
+    """Return the media id and the SHA-256 of the content stored at `path`."""
+    hasher = MediaHasher()
+    with open(path, "rb") as media_file:
+        if os.fstat(media_file.fileno()).st_size == 0:
+            return hasher.hexdigest(), hasher.sha256()
+        with mmap.mmap(media_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset in range(0, len(data), chunk_size):
+                chunk = data[offset:offset + chunk_size]
+                hasher.update(chunk)
+                if hasattr(mmap, "MADV_DONTNEED"):
+                    start = offset - offset % mmap.PAGESIZE
+                    data.madvise(mmap.MADV_DONTNEED, start, offset + len(chunk) - start)
+    return hasher.hexdigest(), hasher.sha256()
+
+
+def media_id(path, chunk_size=CHUNK_SIZE):
+    """Return the id of the media stored at `path`."""
+    return media_digests(path, chunk_size)[0]
+
+
+def file_key(stat):
+    """Attributes of a file that invalidate its manifest entry."""
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+class MediaManifest:
+    """Persistent map of media file path -> id and content hash."""
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.entries = {}
+        self.contents = {}
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.dirty = False
+        try:
+            with open(path, "r", encoding="utf-8") as manifest:
+                self.entries = {
+                    media_path: entry for media_path, entry in json.load(manifest).items()
+                    if "sha256" in entry
+                }
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            logging.warning("Ignoring unreadable media manifest %s", path)
+        for media_path, entry in self.entries.items():
+            self.contents[entry["sha256"]] = media_path
+
+    def lookup(self, media_path, stat):
+        """Return the stored id of a file, None if missing or outdated."""
+        with self.lock:
+            entry = self.entries.get(media_path)
+        if entry is None or entry["key"] != file_key(stat):
+            return None
+        return entry["id"]
+
+    def find_content(self, sha256):
+        """Return (path, id) of an unchanged file with that content or None."""
+        with self.lock:
+            media_path = self.contents.get(sha256)
+            entry = self.entries.get(media_path)
+        if entry is None:
+            return None
+        try:
+            if entry["key"] != file_key(os.stat(media_path)):
+                return None
+        except OSError:
+            return None
+        return media_path, entry["id"]
+
+    def update(self, media_path, stat, media_id_value, sha256):
+        """Store the id and content hash of a file."""
+        with self.lock:
+            old_entry = self.entries.get(media_path)
+            if old_entry and self.contents.get(old_entry["sha256"]) == media_path:
+                del self.contents[old_entry["sha256"]]
+            self.entries[media_path] = {
+                "key": file_key(stat), "id": media_id_value, "sha256": sha256,
+            }
+            self.contents[sha256] = media_path
+            self.dirty = True
+
+    def prune(self, media_paths):
+        """Forget the files not in `media_paths`."""
+        with self.lock:
+            for media_path in set(self.entries) - set(media_paths):
+                entry = self.entries.pop(media_path)
+                if self.contents.get(entry["sha256"]) == media_path:
+                    del self.contents[entry["sha256"]]
+                self.dirty = True
+
+    def save(self):
+        """Write the manifest atomically if it changed."""
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                entries = dict(self.entries)
+                self.dirty = False
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as manifest:
+                json.dump(entries, manifest)
+                manifest.flush()
+                os.fsync(manifest.fileno())
+            os.replace(tmp_path, self.path)
+
+    def media_id(self, media_path):
+        """Return the id of a file, hashing it only if it changed."""
+        stat = os.stat(media_path)
+        cached = self.lookup(media_path, stat)
+        if cached is not None:
+            return cached
+        computed, sha256 = media_digests(media_path)
+        self.update(media_path, stat, computed, sha256)
+        return computed
+
+
+class MediaScanner:
+    """Computes the ids of many files in parallel."""
+
+    def __init__(self, manifest, workers=0):
+        """Initialize a scanner.
+
+        The `workers` argument is the number of hashing processes, 0 uses
+        one per CPU. Workers are spawned, not forked, because the provider
+        process runs Ice threads.
+        """
+        self.manifest = manifest
+        self.workers = workers or os.cpu_count() or 1
+        self.total = 0
+        self.done = 0
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.lock = threading.Lock()
+        self.last_report = 0.0
+
+    def scan(self, media_paths, on_media):
+        """Call `on_media(path, id)` for every file as soon as its id is known.
+
+        Files found in the manifest are reported first, without hashing.
+        The rest are reported in the order their hashing finishes.
+        """
+        files = []
+        for media_path in media_paths:
+            try:
+                files.append((media_path, os.stat(media_path)))
+            except OSError:
+                logging.exception("Cannot read media %s", media_path)
+        with self.lock:
+            self.total = len(files)
+            self.done = 0
+            self.bytes_total = sum(stat.st_size for _, stat in files)
+            self.bytes_done = 0
+
+        pending = []
+        for media_path, stat in files:
+            cached = self.manifest.lookup(media_path, stat)
+            if cached is None:
+                pending.append((media_path, stat))
+                continue
+            on_media(media_path, cached)
+            self.advance(stat.st_size)
+        if not pending:
+            return
+
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(min(self.workers, len(pending)), mp_context=context) as pool:
+            futures = {pool.submit(media_digests, media_path): (media_path, stat)
+                       for media_path, stat in pending}
+            for future in as_completed(futures):
+                media_path, stat = futures[future]
+                try:
+                    computed, sha256 = future.result()
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception("Cannot hash media %s", media_path)
+                else:
+                    self.manifest.update(media_path, stat, computed, sha256)
+                    on_media(media_path, computed)
+                self.advance(stat.st_size)
+
+    def advance(self, size):
+        """Account a processed file and log the progress from time to time."""
+        with self.lock:
+            self.done += 1
+            self.bytes_done += size
+            now = time.monotonic()
+            if now - self.last_report < PROGRESS_INTERVAL and self.done < self.total:
+                return
+            self.last_report = now
+        logging.info("Media scan: %s", self.progress())
+
+    def progress(self):
+        """Return the progress of the current scan."""
+        with self.lock:
+            return (f"{self.done}/{self.total} files, "
+                    f"{self.bytes_done >> 20}/{self.bytes_total >> 20} MiB")
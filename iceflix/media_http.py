@@ -0,0 +1,263 @@
+"""Module for serving media files over HTTP with byte ranges.
+
+`MediaHTTPServer` is a pull-based alternative to the RTP push of the stream
+controllers: players and caches request the URL of a media reader session
+with a `Range` header, so playback can seek, resume and be fronted by an
+HTTP cache. The ETag is the media id, which already is a hash of the content.
+
+The provider registers a session for every MediaReader, so HTTP transfers
+count towards its stream limits and stop being served when the reader is
+closed, expired or revoked. Bodies being sent are limited by the server on
+their own: serving bytes costs little CPU, so downloads do not take the
+transcoding pipeline slots of the provider nor lower the spare capacity it
+announces. Every request carries the user token, in an
+`Authorization: Bearer` header or a `token` query parameter, and the
+session checks it on every request. The body is sent with os.sendfile, so
+the bytes go from the page cache to the socket without passing through
+Python. Where sendfile is not available the file is written from an mmap.
+"""
+
+import logging
+import mmap
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+HTTP_HOST = "127.0.0.1"
+HTTP_PORT = 8080
+HTTP_SERVER_PROPERTY = "StreamProvider.HttpServer"
+HTTP_HOST_PROPERTY = "StreamProvider.HttpHost"
+HTTP_PORT_PROPERTY = "StreamProvider.HttpPort"
+# Bodies sent at the same time, 0 disables the limit
+MAX_TRANSFERS = 32
+MAX_TRANSFERS_PROPERTY = "StreamProvider.HttpMaxTransfers"
+MEDIA_PATH_PREFIX = "/media/"
+SENDFILE_CHUNK = 1 << 24
+# Seconds clients are asked to wait when the node is over budget
+RETRY_AFTER = 5
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header, size):
+    """Return the inclusive (start, end) range of a Range header, None for the whole file.
+
+    Raises ValueError if the range cannot be satisfied. Headers with several
+    ranges or that cannot be parsed are ignored, as RFC 7233 allows.
+    """
+    match = RANGE_PATTERN.match(header.strip()) if header else None
+    if match is None or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if not first:
+        if not int(last) or not size:
+            raise ValueError(header)
+        return max(0, size - int(last)), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError(header)
+    end = min(int(last), size - 1) if last else size - 1
+    return start, end
+
+
+class MediaRequestHandler(BaseHTTPRequestHandler):
+    """Serves GET and HEAD requests of media files."""
+
+    protocol_version = "HTTP/1.1"
+    server_version = "IceFlix"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug("HTTP %s: %s", self.address_string(), format % args)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Send the requested range of a media."""
+        self.send_media(True)
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        """Send the headers of a GET request."""
+        self.send_media(False)
+
+    def user_token(self):
+        """Token of the request, from the Authorization header or the query."""
+        header = self.headers.get("Authorization", "")
+        if header.startswith("Bearer "):
+            return header[len("Bearer "):].strip()
+        return parse_qs(urlsplit(self.path).query).get("token", [""])[0]
+
+    def send_empty(self, status, *headers):
+        """Send a response without body."""
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_media(self, with_body):
+        """Answer a request for a media, with the body if `with_body`."""
+        url = urlsplit(self.path)
+        session_id = parse_qs(url.query).get("session", [""])[0]
+        session = self.server.session(session_id)
+        if not url.path.startswith(MEDIA_PATH_PREFIX) or session is None or \
+                url.path[len(MEDIA_PATH_PREFIX):] != session.media_id:
+            self.send_error(404)
+            return
+        if not session.authorize(self.user_token()):
+            self.send_empty(401, ("WWW-Authenticate", "Bearer"))
+            return
+        media_id = session.media_id
+        try:
+            media_file = open(session.media_path, "rb")  # pylint: disable=consider-using-with
+        except OSError:
+            self.send_error(404)
+            return
+        with media_file:
+            size = os.fstat(media_file.fileno()).st_size
+            etag = f'"{media_id}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            try:
+                byte_range = parse_range(self.headers.get("Range"), size)
+            except ValueError:
+                self.send_empty(416, ("Content-Range", f"bytes */{size}"))
+                return
+            start, end = byte_range or (0, size - 1)
+            transfer = with_body and end >= start
+            if transfer and not self.server.begin_transfer():
+                self.send_empty(503, ("Retry-After", str(RETRY_AFTER)))
+                return
+            try:
+                self.send_range(session_id, media_file, etag, byte_range, size, transfer)
+            finally:
+                if transfer:
+                    self.server.end_transfer()
+
+    def send_range(self, session_id, media_file, etag, byte_range, size, with_body):
+        """Send the headers and, if `with_body`, the bytes of a range."""
+        if byte_range is None:
+            start, end = 0, size - 1
+            self.send_response(200)
+        else:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        length = end - start + 1
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "private")
+        self.end_headers()
+        if not with_body:
+            return
+        try:
+            self.send_body(session_id, media_file, start, length)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+            return
+        self.server.sent(length)
+
+    def send_body(self, session_id, media_file, offset, length):
+        """Send `length` bytes of the file from `offset` without copying them.
+
+        The transfer is cut if the session is closed while it is sent.
+        """
+        self.wfile.flush()
+        if hasattr(os, "sendfile"):
+            while length:
+                if self.server.session(session_id) is None:
+                    raise BrokenPipeError()
+                sent = os.sendfile(self.connection.fileno(), media_file.fileno(),
+                                   offset, min(length, SENDFILE_CHUNK))
+                if not sent:
+                    raise BrokenPipeError()
+                offset += sent
+                length -= sent
+            return
+        with mmap.mmap(media_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            with memoryview(data) as view:
+                self.wfile.write(view[offset:offset + length])
+
+
+class MediaHTTPServer(ThreadingHTTPServer):
+    """HTTP server of the media of a provider.
+
+    Media are served through sessions. A session has `media_id` and
+    `media_path` attributes and an `authorize(user_token)` method that
+    checks the token of a request and renews the session lease. At most
+    `max_transfers` bodies are sent at the same time, requests over the
+    limit are answered with 503.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host=HTTP_HOST, port=HTTP_PORT, max_transfers=MAX_TRANSFERS):
+        super().__init__((host, port), MediaRequestHandler)
+        self.sessions = {}
+        self.thread = None
+        self.bytes_sent = 0
+        self.requests = 0
+        self.max_transfers = max_transfers
+        self.transfers = 0
+        self.lock = threading.Lock()
+
+    def url(self, media_id, session_id=""):
+        """URL of a media in this server."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{MEDIA_PATH_PREFIX}{media_id}?session={session_id}"
+
+    def register(self, session_id, session):
+        """Serve a session."""
+        with self.lock:
+            self.sessions[session_id] = session
+
+    def unregister(self, session_id):
+        """Stop serving a session, transfers in progress are cut."""
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def session(self, session_id):
+        """Return a registered session or None."""
+        with self.lock:
+            return self.sessions.get(session_id)
+
+    def begin_transfer(self):
+        """Account a body about to be sent, False if the limit is reached."""
+        with self.lock:
+            if self.max_transfers and self.transfers >= self.max_transfers:
+                return False
+            self.transfers += 1
+            return True
+
+    def end_transfer(self):
+        """Account a body no longer being sent."""
+        with self.lock:
+            self.transfers -= 1
+
+    def sent(self, length):
+        """Account a body sent."""
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += length
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        host, port = self.server_address[:2]
+        logging.info("Serving media over HTTP at http://%s:%d", host, port)
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        self.shutdown()
+        self.server_close()
+
+    def stats(self):
+        """Return a summary of the bodies sent."""
+        with self.lock:
+            return f"{self.requests} responses, {self.bytes_sent >> 20} MiB sent"
@@ -0,0 +1,281 @@
+"""Module for receiving media uploads.
+
+`receive_upload` pulls the content from a MediaUploader keeping several
+`receiveAsync` requests in flight, so the transfer is not bound by the
+round trip time. The content is hashed while it is written to a temporary
+file next to the destination, which is renamed over it only when the whole
+file arrived. Memory use does not depend on the size of the file.
+
+MediaUploader.receive has no offset: chunks are returned in the order the
+requests are dispatched, which is only the order they were sent if the
+uploader dispatches them on a single thread. Nothing tells how the client
+is configured, so the window is opt-in: it is only used when the caller
+of uploadMedia sends the SHA-256 of the file (UPLOAD_SHA256_CONTEXT), and
+the received content is checked against it before the destination is
+written. A reordered file is then rejected instead of stored under a
+wrong id. Callers that do not send it, which includes every uploadMedia
+caller shipped here, get a window of 1: one round trip per chunk, where
+the gain over the previous loop comes from the larger chunks alone. The
+bundled client uploads with the resumable sessions below instead.
+
+`UploadSessions` implements the resumable uploads pushed by the client:
+chunks are written at an offset in a temporary file, so an interrupted
+upload continues from the stored offset. Content is identified by its
+SHA-256: a file with the same content as a stored one, known ahead from the
+hash given by the client or found when the upload is committed, is hard
+linked instead of stored twice.
+"""
+
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+
+import Ice
+
+try:
+    import IceFlix
+except ImportError:
+    Ice.loadSlice(os.path.join(os.path.dirname(__file__), "iceflix.ice"))
+    import IceFlix
+from media_hashing import MediaHasher, media_digests
+
+UPLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_WINDOW = 8
+UPLOAD_CHUNK_SIZE_PROPERTY = "StreamProvider.UploadChunkSize"
+UPLOAD_WINDOW_PROPERTY = "StreamProvider.UploadWindow"
+# Context entry of uploadMedia with the SHA-256 of the file
+UPLOAD_SHA256_CONTEXT = "sha256"
+UPLOAD_SESSION_TTL = 3600.0
+TEMP_PREFIX = ".upload-"
+SHA256_PATTERN = re.compile("^[0-9a-f]{64}$")
+
+
+def is_temp_file(name):
+    """Check if a file name belongs to an upload in progress."""
+    return os.path.basename(name).startswith(TEMP_PREFIX)
+
+
+def receive_upload(uploader, size, destination, chunk_size=UPLOAD_CHUNK_SIZE,
+                   window=UPLOAD_WINDOW, sha256=""):
+    """Receive `size` bytes from `uploader` into `destination`.
+
+    Returns the media id and the SHA-256 of the content. Raises
+    IceFlix.UploadError if the transfer fails, the uploader sends less
+    data than expected or the content does not match `sha256`, leaving
+    `destination` untouched. Without `sha256` the window is 1, see the
+    module docstring.
+    """
+    if not sha256:
+        window = 1
+    hasher = MediaHasher()
+    descriptor, temp_path = tempfile.mkstemp(
+        prefix=TEMP_PREFIX, dir=os.path.dirname(destination) or ".")
+    try:
+        with os.fdopen(descriptor, "wb") as media_file:
+            pending = deque()
+            requested = 0
+            while True:
+                while requested < size and len(pending) < window:
+                    length = min(chunk_size, size - requested)
+                    pending.append(uploader.receiveAsync(length))
+                    requested += length
+                if not pending:
+                    break
+                chunk = pending.popleft().result()
+                if not chunk:
+                    break
+                media_file.write(chunk)
+                hasher.update(chunk)
+            media_file.flush()
+            os.fsync(media_file.fileno())
+        if hasher.size != size or (sha256 and hasher.sha256() != sha256):
+            logging.warning("Upload %s does not match its size or hash", destination)
+            raise IceFlix.UploadError()
+        os.replace(temp_path, destination)
+    except (Ice.Exception, OSError):
+        os.unlink(temp_path)
+        raise IceFlix.UploadError()
+    return hasher.hexdigest(), hasher.sha256()
+
+
+class UploadSession:
+    """State of a resumable upload."""
+
+    def __init__(self, destination, size, sha256, temp_path):
+        self.session_id = str(uuid.uuid4())
+        self.destination = destination
+        self.size = size
+        self.sha256 = sha256
+        self.temp_path = temp_path
+        self.offset = 0
+        self.media_id = ""
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def state(self):
+        """Return the state sent to the client."""
+        return IceFlix.UploadSessionState(self.session_id, self.offset, self.media_id)
+
+
+class UploadSessions:
+    """Resumable uploads into a media directory deduplicated by content."""
+
+    def __init__(self, directory, manifest, ttl=UPLOAD_SESSION_TTL):
+        """Initialize the sessions.
+
+        Temporary files left in `directory` by a previous run are removed.
+        Sessions not used for `ttl` seconds are discarded with their data.
+        """
+        self.directory = directory
+        self.manifest = manifest
+        self.ttl = ttl
+        self.sessions = {}
+        self.lock = threading.Lock()
+        for entry in os.scandir(directory):
+            if is_temp_file(entry.name):
+                os.unlink(entry.path)
+
+    def begin(self, file_name, size, sha256=""):
+        """Start or resume the upload of `size` bytes into `file_name`.
+
+        An upload of the same name, size and hash that is not committed is
+        resumed. If `sha256` matches stored content, the file is linked and
+        the returned session is already committed.
+        """
+        if size < 0 or (sha256 and not SHA256_PATTERN.match(sha256)):
+            raise IceFlix.UploadError()
+        destination = os.path.join(self.directory, os.path.basename(file_name))
+        self.expire()
+        with self.lock:
+            for session in self.sessions.values():
+                if (session.destination, session.size, session.sha256) == \
+                        (destination, size, sha256) and not session.media_id:
+                    session.last_used = time.monotonic()
+                    return session
+        existing = self.manifest.find_content(sha256) if sha256 else None
+        if existing is not None:
+            session = UploadSession(destination, size, sha256, None)
+            session.media_id = self.link(existing, destination, sha256)
+            session.offset = size
+        else:
+            if os.path.exists(destination):
+                raise IceFlix.UploadError()
+            descriptor, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=self.directory)
+            os.close(descriptor)
+            session = UploadSession(destination, size, sha256, temp_path)
+        with self.lock:
+            self.sessions[session.session_id] = session
+        return session
+
+    def get(self, session_id):
+        """Return a session or raise UploadError if it does not exist."""
+        with self.lock:
+            session = self.sessions.get(session_id)
+        if session is None:
+            raise IceFlix.UploadError()
+        session.last_used = time.monotonic()
+        return session
+
+    def write(self, session_id, offset, data):
+        """Store a chunk at `offset` and return the bytes stored so far.
+
+        Chunks can be sent again, but not after a gap.
+        """
+        session = self.get(session_id)
+        with session.lock:
+            if session.temp_path is None or offset < 0 or offset > session.offset or \
+                    offset + len(data) > session.size:
+                raise IceFlix.UploadError()
+            try:
+                with open(session.temp_path, "r+b") as media_file:
+                    media_file.seek(offset)
+                    media_file.write(data)
+            except OSError:
+                raise IceFlix.UploadError()
+            session.offset = max(session.offset, offset + len(data))
+            return session.offset
+
+    def commit(self, session_id):
+        """Finish an upload and return its media id.
+
+        The content is hashed from the temporary file. If it does not match
+        the hash given by the client the session is discarded.
+        """
+        session = self.get(session_id)
+        with session.lock:
+            if session.media_id:
+                return session.media_id
+            if session.temp_path is None or session.offset != session.size:
+                raise IceFlix.UploadError()
+            try:
+                with open(session.temp_path, "r+b") as media_file:
+                    os.fsync(media_file.fileno())
+                computed, sha256 = media_digests(session.temp_path)
+            except OSError:
+                self.discard(session)
+                raise IceFlix.UploadError()
+            if session.sha256 and sha256 != session.sha256:
+                logging.warning("Upload %s does not match its hash", session.destination)
+                self.discard(session)
+                raise IceFlix.UploadError()
+            existing = self.manifest.find_content(sha256)
+            if existing is not None:
+                os.unlink(session.temp_path)
+                session.media_id = self.link(existing, session.destination, sha256)
+            elif os.path.exists(session.destination):
+                self.discard(session)
+                raise IceFlix.UploadError()
+            else:
+                os.replace(session.temp_path, session.destination)
+                self.manifest.update(session.destination, os.stat(session.destination),
+                                     computed, sha256)
+                session.media_id = computed
+            session.temp_path = None
+        self.save_manifest()
+        return session.media_id
+
+    def link(self, existing, destination, sha256):
+        """Make `destination` hold the stored content. Returns its media id."""
+        existing_path, existing_id = existing
+        if os.path.abspath(existing_path) != os.path.abspath(destination):
+            if os.path.exists(destination):
+                raise IceFlix.UploadError()
+            try:
+                os.link(existing_path, destination)
+            except OSError:
+                shutil.copyfile(existing_path, destination)
+            self.manifest.update(destination, os.stat(destination), existing_id, sha256)
+        logging.info("Upload %s deduplicated with %s", destination, existing_path)
+        self.save_manifest()
+        return existing_id
+
+    def discard(self, session):
+        """Drop a session and its data."""
+        with self.lock:
+            self.sessions.pop(session.session_id, None)
+        if session.temp_path and os.path.exists(session.temp_path):
+            os.unlink(session.temp_path)
+        session.temp_path = None
+
+    def expire(self):
+        """Discard the sessions not used for `ttl` seconds."""
+        deadline = time.monotonic() - self.ttl
+        with self.lock:
+            expired = [session for session in self.sessions.values()
+                       if session.last_used < deadline]
+        for session in expired:
+            with session.lock:
+                self.discard(session)
+
+    def save_manifest(self):
+        """Persist the manifest after a new file is stored."""
+        try:
+            self.manifest.save()
+        except OSError:
+            logging.exception("Cannot save the media manifest")
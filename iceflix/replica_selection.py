@@ -0,0 +1,202 @@
+"""Module for load-aware selection among replicas of a service.
+
+A `ReplicaSelector` follows a registry of proxies (for example the
+`authenticators` map of a ServiceAnnouncementsListener), checks their
+liveness in the background with asynchronous pings and picks one of the
+healthy replicas according to a policy. The pick is pinged before it is
+returned, and another replica is picked if it does not answer:
+
+- "p2c": power of two choices, the faster of two random healthy replicas.
+- "least-loaded": the healthy replica with the lowest latency.
+- "round-robin": every healthy replica in turn.
+
+Main only hands out proxies, the calls go from the clients to the replicas,
+so the load of a replica is estimated by the EWMA of its ping latency.
+"""
+
+import itertools
+import logging
+import random
+import threading
+import time
+
+import Ice
+
+POLICIES = ("p2c", "least-loaded", "round-robin")
+DEFAULT_POLICY = "p2c"
+CHECK_INTERVAL = 2.0
+CHECK_TIMEOUT = 1.0
+EWMA_ALPHA = 0.3
+
+
+class Replica:
+    """State of a single replica."""
+
+    def __init__(self, service_id, proxy):
+        self.service_id = service_id
+        self.proxy = proxy
+        self.latency = None
+        self.healthy = True
+        self.last_check = None
+
+    def observe(self, latency):
+        """Add a latency sample to the EWMA."""
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency
+
+    def score(self):
+        """Expected cost of sending one more call to this replica."""
+        return self.latency or 0.0
+
+
+class ReplicaSelector:
+    """Keeps the health of a set of replicas and picks one of them."""
+
+    def __init__(self, source, policy=DEFAULT_POLICY, interval=CHECK_INTERVAL,
+                 timeout=CHECK_TIMEOUT):
+        """Initialize a selector.
+
+        The `source` argument should be a callable returning a dict of
+        service id -> proxy with the current replicas. It is read again
+        before every selection and every round of checks.
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown selection policy {policy}")
+        self.source = source
+        self.policy = policy
+        self.interval = interval
+        self.timeout = timeout
+        self.replicas = {}
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def refresh(self):
+        """Follow the additions and removals of the source registry."""
+        current = dict(self.source())
+        with self.lock:
+            for service_id in list(self.replicas):
+                if service_id not in current:
+                    del self.replicas[service_id]
+            for service_id, proxy in current.items():
+                replica = self.replicas.get(service_id)
+                if replica is None or replica.proxy != proxy:
+                    self.replicas[service_id] = Replica(service_id, proxy)
+
+    def pick(self, exclude=()):
+        """Pick a healthy replica according to the policy, None if there is none."""
+        with self.lock:
+            candidates = [replica for replica in self.replicas.values()
+                          if replica.healthy and replica.service_id not in exclude]
+            if not candidates:
+                return None
+            if self.policy == "round-robin":
+                candidates.sort(key=lambda replica: replica.service_id)
+                return candidates[next(self.counter) % len(candidates)]
+            if self.policy == "least-loaded":
+                return min(candidates, key=Replica.score)
+            if len(candidates) == 1:
+                return candidates[0]
+            return min(random.sample(candidates, 2), key=Replica.score)
+
+    def select(self):
+        """Return the proxy of a live replica, None if every replica is dead.
+
+        The background checks can be up to `interval` seconds old, so the
+        picked replica is pinged first and, if it is dead, the next one is
+        picked. If the checks consider all of them dead, the rest are pinged
+        one after another so the call still fails over to any replica that
+        came back.
+        """
+        self.refresh()
+        tried = set()
+        while True:
+            replica = self.pick(tried)
+            if replica is None:
+                break
+            if self.probe(replica):
+                return replica.proxy
+            tried.add(replica.service_id)
+        with self.lock:
+            unhealthy = [replica for replica in self.replicas.values()
+                         if replica.service_id not in tried]
+        random.shuffle(unhealthy)
+        for replica in unhealthy:
+            if self.probe(replica):
+                return replica.proxy
+        return None
+
+    def probe(self, replica):
+        """Ping a replica synchronously and update its state."""
+        start = time.monotonic()
+        try:
+            replica.proxy.ice_invocationTimeout(int(self.timeout * 1000)).ice_ping()
+        except Ice.LocalException:
+            self.mark_failed(replica.service_id)
+            return False
+        self.mark_alive(replica.service_id, time.monotonic() - start)
+        return True
+
+    def mark_alive(self, service_id, latency):
+        """Record a successful call or check."""
+        with self.lock:
+            replica = self.replicas.get(service_id)
+            if replica is None:
+                return
+            if not replica.healthy:
+                logging.info("Replica %s is alive again", service_id)
+            replica.healthy = True
+            replica.last_check = time.monotonic()
+            replica.observe(latency)
+
+    def mark_failed(self, service_id):
+        """Record a failed call or check."""
+        with self.lock:
+            replica = self.replicas.get(service_id)
+            if replica is None:
+                return
+            if replica.healthy:
+                logging.info("Replica %s is not responding", service_id)
+            replica.healthy = False
+            replica.last_check = time.monotonic()
+
+    def check(self):
+        """Ping every replica in parallel with asynchronous invocations."""
+        self.refresh()
+        with self.lock:
+            replicas = list(self.replicas.values())
+        timeout = int(self.timeout * 1000)
+        for replica in replicas:
+            start = time.monotonic()
+            future = replica.proxy.ice_invocationTimeout(timeout).ice_pingAsync()
+            future.add_done_callback(
+                lambda future, replica=replica, start=start: self.checked(replica, start, future))
+
+    def checked(self, replica, start, future):
+        """Completion callback of a background check."""
+        if future.exception() is None:
+            self.mark_alive(replica.service_id, time.monotonic() - start)
+        else:
+            self.mark_failed(replica.service_id)
+
+    def run(self):
+        """Check the replicas every `interval` seconds until stopped."""
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Error checking replicas")
+
+    def start(self):
+        """Start the background checks."""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background checks."""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
@@ -4,10 +4,16 @@
 RTSP implementation based on gstreamer and libVlc
 """
 
+import hashlib
+import ipaddress
 import shlex
+import os
 import os.path
 import logging
+import queue
+import struct
 import subprocess
+import threading
 
 try:
     import vlc
@@ -23,19 +29,223 @@ FILE_PIPE = (
     'filesrc location="{}" ! decodebin ! x264enc ! h264parse config-interval=5 ! '
     "mpegtsmux ! rtpmp2tpay ! udpsink host={} port={}"
 )
+# Encode once, streaming and storing the MPEG-TS in the transcoding cache
+RECORD_PIPE = (
+    'filesrc location="{}" ! decodebin ! x264enc ! h264parse config-interval=5 ! '
+    "mpegtsmux ! tee name=ts ! queue ! rtpmp2tpay ! udpsink host={} port={} "
+    'ts. ! queue ! filesink location="{}"'
+)
+# H.264 sources and cached outputs are only remuxed
+PASSTHROUGH_PIPE = (
+    'filesrc location="{}" ! qtdemux ! h264parse config-interval=5 ! '
+    "mpegtsmux ! rtpmp2tpay ! udpsink host={} port={}"
+)
+CACHED_PIPE = (
+    'filesrc location="{}" ! tsdemux ! h264parse config-interval=5 ! '
+    "mpegtsmux ! rtpmp2tpay ! udpsink host={} port={}"
+)
+TRANSCODE_PIPE = (
+    'filesrc location="{}" ! decodebin ! x264enc ! h264parse config-interval=5 ! '
+    'mpegtsmux ! filesink location="{}"'
+)
+
+TRANSCODE_CACHE_DIR = "transcode_cache"
+TRANSCODE_CACHE_SIZE = 10 * 1024
+TRANSCODE_CACHE_DIR_PROPERTY = "StreamProvider.TranscodeCacheDir"
+TRANSCODE_CACHE_SIZE_PROPERTY = "StreamProvider.TranscodeCacheSize"
+MP4_CONTAINERS = (b"moov", b"trak", b"mdia", b"minf", b"stbl")
+
+MULTICAST_BASE = "239.255.42.1"
+MULTICAST_GROUPS = 254
+MULTICAST_PORT = 5004
+SHARED_STREAMS_PROPERTY = "StreamProvider.SharedStreams"
+MULTICAST_BASE_PROPERTY = "StreamProvider.MulticastBase"
+MULTICAST_PORT_PROPERTY = "StreamProvider.MulticastPort"
+
+
+def _mp4_boxes(media_file, start, end):
+    """Yield (type, payload start, payload end) of the MP4 boxes in a range"""
+    offset = start
+    while offset + 8 <= end:
+        media_file.seek(offset)
+        size, box_type = struct.unpack(">I4s", media_file.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", media_file.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            return
+        yield box_type, offset + header, min(offset + size, end)
+        offset += size
+
+
+def is_h264(media_file):
+    """Check if an MP4 file has an H.264 video track"""
+    try:
+        with open(media_file, "rb") as media:
+            pending = [(0, os.fstat(media.fileno()).st_size)]
+            while pending:
+                start, end = pending.pop()
+                for box_type, payload_start, payload_end in _mp4_boxes(media, start, end):
+                    if box_type in MP4_CONTAINERS:
+                        pending.append((payload_start, payload_end))
+                    elif box_type == b"stsd":
+                        media.seek(payload_start)
+                        entries = media.read(min(payload_end - payload_start, 4096))
+                        if b"avc1" in entries or b"avc3" in entries:
+                            return True
+    except (OSError, struct.error):
+        logging.warning("Cannot read the tracks of %s", media_file)
+    return False
+
+
+class TranscodeCache:
+    """Stores the H.264 MPEG-TS output of every transcoded media.
+
+    The first play of a media that is not H.264 records the encoded stream,
+    the following plays only remux it. If that viewer stops before the end
+    the partial recording is discarded and the media is transcoded again by
+    a process not tied to any viewer, in a background worker that handles
+    one media at a time. Outputs are keyed by the path, size and
+    modification time of the source and the least recently played ones are
+    removed when the cache exceeds `max_bytes`.
+    """
+
+    def __init__(self, directory=TRANSCODE_CACHE_DIR, max_bytes=TRANSCODE_CACHE_SIZE << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.recording = set()
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.worker = None
+        self.process = None
+        self.stopped = False
+        os.makedirs(directory, exist_ok=True)
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".part"):
+                os.unlink(entry.path)
+
+    def path(self, media_file):
+        """Path of the cached output of a media file"""
+        stat = os.stat(media_file)
+        key = f"{os.path.abspath(media_file)}:{stat.st_size}:{stat.st_mtime_ns}"
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + ".ts")
+
+    def lookup(self, media_file):
+        """Return the cached output of a media file or None"""
+        cached = self.path(media_file)
+        try:
+            os.utime(cached)
+        except FileNotFoundError:
+            return None
+        return cached
+
+    def begin(self, media_file):
+        """Return a temporary path to record a media file, None if it is already recording"""
+        cached = self.path(media_file)
+        with self.lock:
+            if cached in self.recording:
+                return None
+            self.recording.add(cached)
+        return cached + ".part"
+
+    def finish(self, media_file, temp_path, completed):
+        """Store a recording if it completed, discard it otherwise"""
+        cached = temp_path[:-len(".part")]
+        try:
+            if completed and os.path.getsize(temp_path) > 0:
+                os.replace(temp_path, cached)
+                logging.info("Stored transcoded %s", media_file)
+                self.evict()
+            elif os.path.exists(temp_path):
+                os.unlink(temp_path)
+        finally:
+            with self.lock:
+                self.recording.discard(cached)
+
+    def transcode(self, media_file):
+        """Fill the cache for a media file without streaming it"""
+        if is_h264(media_file) or self.lookup(media_file):
+            return
+        temp_path = self.begin(media_file)
+        if temp_path is None:
+            return
+        pipe = TRANSCODE_PIPE.format(media_file, temp_path)
+        with self.lock:
+            self.process = subprocess.Popen(  # pylint: disable=consider-using-with
+                shlex.split(f"gst-launch-1.0 {pipe}"))
+        returncode = self.process.wait()
+        self.finish(media_file, temp_path, returncode == 0)
+
+    def schedule(self, media_file):
+        """Transcode a media file in the background worker"""
+        with self.lock:
+            if self.stopped:
+                return
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._work_, daemon=True)
+                self.worker.start()
+        self.pending.put(media_file)
+
+    def _work_(self):
+        """Transcode the scheduled media files one after another until stopped"""
+        while True:
+            media_file = self.pending.get()
+            if self.stopped:
+                return
+            try:
+                self.transcode(media_file)
+            except (OSError, subprocess.SubprocessError):
+                logging.exception("Error transcoding %s", media_file)
+
+    def stop(self):
+        """Stop the background worker, a transcoding in progress is discarded"""
+        with self.lock:
+            self.stopped = True
+            if self.process is not None and self.process.poll() is None:
+                self.process.terminate()
+        self.pending.put(None)
+
+    def evict(self):
+        """Remove the least recently played outputs over the size limit"""
+        entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".ts")]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            total -= entry.stat().st_size
+            os.unlink(entry.path)
+            logging.info("Evicted %s from the transcoding cache", entry.name)
 
 
 class RTSPEmitter:
     """Handling RTSP streaming to a given destination"""
 
-    def __init__(self, media_file, dest_host, dest_port):
+    def __init__(self, media_file, dest_host, dest_port, cache=None):
         self._host_ = dest_host
         self._port_ = dest_port
+        self._media_ = media_file
+        self._cache_ = cache
+        self._record_ = None
+        self._storer_ = None
         if not os.path.exists(media_file):
             logging.warning("No media file found! Use test signal")
             self._pipe_ = TEST_PIPE.format(self._host_, self._port_)
+        elif is_h264(media_file):
+            self._pipe_ = PASSTHROUGH_PIPE.format(media_file, self._host_, self._port_)
+        elif cache is not None and cache.lookup(media_file):
+            self._pipe_ = CACHED_PIPE.format(
+                cache.lookup(media_file), self._host_, self._port_)
         else:
-            self._pipe_ = FILE_PIPE.format(media_file, self._host_, self._port_)
+            self._record_ = cache.begin(media_file) if cache is not None else None
+            if self._record_:
+                self._pipe_ = RECORD_PIPE.format(
+                    media_file, self._host_, self._port_, self._record_)
+            else:
+                self._pipe_ = FILE_PIPE.format(media_file, self._host_, self._port_)
 
         logging.debug("GST Pipe: %s", self._pipe_)
         self._proc_ = None
@@ -45,14 +255,34 @@ class RTSPEmitter:
         self._proc_ = subprocess.Popen(  # pylint: disable=consider-using-with
             shlex.split(f"gst-launch-1.0 {self._pipe_}"),
         )
+        if self._record_:
+            self._storer_ = threading.Thread(target=self._store_, daemon=True)
+            self._storer_.start()
+
+    def _store_(self):
+        """Keep the recording in the cache if the whole media was streamed
+
+        Otherwise the media is transcoded again apart from the viewer.
+        """
+        returncode = self._proc_.wait()
+        self._cache_.finish(self._media_, self._record_, returncode == 0)
+        if returncode != 0:
+            self._cache_.schedule(self._media_)
 
     def stop(self):
         """Stop streaming"""
         self._proc_.terminate()
 
+    @property
+    def running(self):
+        """Check if the streaming process is alive"""
+        return self._proc_ is not None and self._proc_.poll() is None
+
     def wait(self):
         """Wait until streaming process terminates"""
         self._proc_.wait()
+        if self._storer_:
+            self._storer_.join()
 
     @property
     def playback_uri(self):
@@ -60,6 +290,70 @@ class RTSPEmitter:
         return f"rtp://@{self._host_}:{self._port_}"
 
 
+class SharedStream:
+    """A pipeline playing a media for several viewers"""
+
+    def __init__(self, emitter, group):
+        self.emitter = emitter
+        self.group = group
+        self.viewers = 0
+
+
+class SharedEmitters:
+    """Emitters shared by the concurrent viewers of the same media.
+
+    Every media being played has a single pipeline sending to its own
+    multicast group and every viewer joins that group, so the media is read
+    and encoded once however many users watch it. The pipeline stops when
+    the last viewer leaves. If the media ends first, the next viewer starts
+    it again.
+    """
+
+    def __init__(self, base_group=MULTICAST_BASE, port=MULTICAST_PORT,
+                 groups=MULTICAST_GROUPS, cache=None):
+        first = ipaddress.ip_address(base_group)
+        self.free_groups = [str(first + num) for num in range(groups)]
+        self.port = port
+        self.cache = cache
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def join(self, media_file):
+        """Add a viewer to the stream of a media, None if no group is free"""
+        with self.lock:
+            stream = self.streams.get(media_file)
+            if stream is None:
+                if not self.free_groups:
+                    logging.warning("No multicast group free for %s", media_file)
+                    return None
+                group = self.free_groups.pop(0)
+                stream = SharedStream(RTSPEmitter(media_file, group, self.port, self.cache), group)
+                self.streams[media_file] = stream
+                stream.emitter.start()
+                threading.Thread(target=self._watch_, args=(media_file, stream),
+                                 daemon=True).start()
+            stream.viewers += 1
+            logging.info("%d viewers of %s", stream.viewers, media_file)
+            return stream
+
+    def leave(self, media_file, stream):
+        """Remove a viewer, stopping the pipeline if it was the last one"""
+        with self.lock:
+            stream.viewers -= 1
+            if stream.viewers > 0 or self.streams.get(media_file) is not stream:
+                return
+            del self.streams[media_file]
+        stream.emitter.stop()
+
+    def _watch_(self, media_file, stream):
+        """Release the group of a stream once its pipeline ends"""
+        stream.emitter.wait()
+        with self.lock:
+            if self.streams.get(media_file) is stream:
+                del self.streams[media_file]
+            self.free_groups.append(stream.group)
+
+
 class RTSPPlayer:
     """RTSP player using SDP file"""
 
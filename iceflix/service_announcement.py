@@ -6,6 +6,8 @@ You can reuse it in all your services.
 import logging
 import os
 import threading
+import time
+from collections import deque
 
 import Ice
 
@@ -17,6 +19,25 @@ except ImportError:
 
 logging.basicConfig(level=logging.INFO)
 
+ANNOUNCE_INTERVAL = 10.0
+# A service is suspected dead after missing this many seconds of announcements
+SUSPECT_TIMEOUT = 2.5 * ANNOUNCE_INTERVAL
+CHECK_INTERVAL = 5.0
+PING_TIMEOUT = 2000
+# Context entry carrying the type id of the announced service
+SERVICE_TYPE_CONTEXT = "serviceType"
+# Context entry with the streams a StreamProvider can still start
+SPARE_CAPACITY_CONTEXT = "spareCapacity"
+# Timeout in milliseconds and concurrency of the transfers to new services
+TRANSFER_TIMEOUT = 30000
+MAX_TRANSFERS = 4
+SERVICE_TYPES = {
+    IceFlix.MainPrx.ice_staticId(): IceFlix.MainPrx,
+    IceFlix.AuthenticatorPrx.ice_staticId(): IceFlix.AuthenticatorPrx,
+    IceFlix.MediaCatalogPrx.ice_staticId(): IceFlix.MediaCatalogPrx,
+    IceFlix.StreamProviderPrx.ice_staticId(): IceFlix.StreamProviderPrx,
+}
+
 class ServiceAnnouncementsListener(IceFlix.ServiceAnnouncements):
     """Listener for the ServiceAnnouncements topic."""
 
@@ -43,6 +64,12 @@ class ServiceAnnouncementsListener(IceFlix.ServiceAnnouncements):
         self.mains = {}
         self.providers = {}
         self.known_ids = set()
+        self.last_seen = {}
+        self.service_types = {}
+        self.service_status = {}
+        self.lock = threading.RLock()
+        self.checks_stopped = threading.Event()
+        self.checks_thread = None
 
     def newService(
         self, service, service_id, current
@@ -52,106 +79,303 @@ class ServiceAnnouncementsListener(IceFlix.ServiceAnnouncements):
         if service_id == self.service_id:
             logging.debug("Received own announcement. Ignoring")
             return
-        if self.own_type == IceFlix.StreamProviderPrx and service.ice_isA("::IceFlix::MediaCatalog"):
+        service_type = self.resolve_type(service, service_id, current)
+        if self.own_type == IceFlix.StreamProviderPrx and service_type == IceFlix.MediaCatalogPrx.ice_staticId():
             self.servant.reannounceMedia(service_id)
-        proxy = self.own_type.checkedCast(service)
-        if proxy:
-            self.servant.share_data_with(proxy)
+        if service_type == self.own_type.ice_staticId():
+            self.servant.share_data_with(self.own_type.uncheckedCast(service))
+
+    def resolve_type(self, service, service_id, current):
+        """Return the IceFlix type id of a service, "" if it is not an IceFlix service.
+
+        The type is taken from the announcement context when the sender
+        includes it. Otherwise it is asked once with ice_ids() and cached
+        for the service id.
+        """
+        service_type = self.service_types.get(service_id)
+        if service_type is not None:
+            return service_type
+        service_type = current.ctx.get(SERVICE_TYPE_CONTEXT) if current else None
+        if service_type not in SERVICE_TYPES:
+            service_type = next(
+                (type_id for type_id in service.ice_ids() if type_id in SERVICE_TYPES), ""
+            )
+        self.service_types[service_id] = service_type
+        return service_type
 
     def announce(self, service, service_id, current):  # pylint: disable=unused-argument
         """Receive an announcement."""
-        # self.checkServices()
+        if current is not None and current.ctx:
+            self.service_status[service_id] = dict(current.ctx)
+        if service_id in self.known_ids:
+            self.last_seen[service_id] = time.monotonic()
         if service_id == self.service_id or service_id in self.known_ids:
             logging.debug("Received own announcement or already known. Ignoring")
             return
+        self.last_seen[service_id] = time.monotonic()
 
-        if service.ice_isA("::IceFlix::Main"):
-            logging.debug("Main service received")
-            self.mains[service_id] = IceFlix.MainPrx.uncheckedCast(service)
-            self.known_ids.add(service_id)
+        service_type = self.resolve_type(service, service_id, current)
+        if not service_type:
+            logging.info("Received annoucement from unknown service %s", service_id)
+            return
 
-        elif service.ice_isA("::IceFlix::Authenticator"):
-            logging.debug("Authenticator service received")
-            self.authenticators[service_id] = IceFlix.AuthenticatorPrx.uncheckedCast(
-                service
-            )
-            self.known_ids.add(service_id)
+        logging.debug("%s service received", service_type.split("::")[-1])
+        proxy = self.register(service_id, service, service_type)
+        if service_type == IceFlix.AuthenticatorPrx.ice_staticId() and self.own_type == IceFlix.AuthenticatorPrx:
+            self.servant.authenticator_found(proxy)
 
-        elif service.ice_isA("::IceFlix::MediaCatalog"):
-            logging.debug("MediaCatalog service received")
-            self.catalogs[service_id] = IceFlix.MediaCatalogPrx.uncheckedCast(service)
-            self.known_ids.add(service_id)
+    def register(self, service_id, service, service_type):
+        """Add a service to the map of its type and return its typed proxy.
 
-        elif service.ice_isA("::IceFlix::StreamProvider"):
-            logging.debug("StreamProvider service received")
-            self.providers[service_id] = IceFlix.StreamProviderPrx.uncheckedCast(service)
+        Services learnt from another service (see Main.updateDB) are
+        registered with their proxy string as id. That entry is replaced
+        when the service announces itself with its real id.
+        """
+        registry = self.registries()[service_type.split("::")[-1]]
+        proxy = SERVICE_TYPES[service_type].uncheckedCast(service)
+        placeholder = str(service)
+        with self.lock:
+            if placeholder != service_id and placeholder in registry:
+                del registry[placeholder]
+                self.known_ids.discard(placeholder)
+            registry[service_id] = proxy
             self.known_ids.add(service_id)
+            self.last_seen[service_id] = time.monotonic()
+        return proxy
+
+    def registries(self):
+        """Return the per-type maps of known services."""
+        return {
+            "Main": self.mains,
+            "Authenticator": self.authenticators,
+            "MediaCatalog": self.catalogs,
+            "StreamProvider": self.providers,
+        }
+
+    def evict(self, service_id):
+        """Forget a service that is considered dead."""
+        with self.lock:
+            for registry in self.registries().values():
+                registry.pop(service_id, None)
+            self.known_ids.discard(service_id)
+            self.last_seen.pop(service_id, None)
+            self.service_types.pop(service_id, None)
+            self.service_status.pop(service_id, None)
+        logging.info("Service %s evicted", service_id)
+
+    def spare_capacity(self, service_id):
+        """Spare capacity last announced by a service, None if it did not send any."""
+        try:
+            return int(self.service_status.get(service_id, {})[SPARE_CAPACITY_CONTEXT])
+        except (KeyError, ValueError):
+            return None
 
-        else:
-            logging.info(
-                "Received annoucement from unknown service %s: %s",
-                service_id,
-                service.ice_ids(),
-            )
     # pylint: disable=C0103
     def checkServices(self):
-        # pylint: disable=C0201
-        for main in self.mains.keys():
-            try:
-                self.mains[main].ice_ping()
-            except Ice.LocalException:
-                del self.mains[main]
-                self.known_ids.remove(main)
-        # pylint: disable=C0201
-        for auth in self.authenticators.keys():
-            try:
-                self.authenticators[auth].ice_ping()
-            except Ice.LocalException:
-                del self.authenticators[auth]
-                self.known_ids.remove(auth)
-        # pylint: disable=C0201
-        for catalog in self.catalogs.keys():
+        """Ping the services that missed their announcements and evict the dead ones.
+
+        The pings are sent in parallel with asynchronous invocations. A
+        suspected service that still answers is kept.
+        """
+        now = time.monotonic()
+        with self.lock:
+            suspects = [
+                (service_id, registry[service_id])
+                for registry in self.registries().values()
+                for service_id in list(registry)
+                if now - self.last_seen.get(service_id, now) > SUSPECT_TIMEOUT
+            ]
+        for service_id, proxy in suspects:
+            logging.debug("Service %s missed its announcements, checking it", service_id)
+            future = proxy.ice_invocationTimeout(PING_TIMEOUT).ice_pingAsync()
+            future.add_done_callback(
+                lambda future, service_id=service_id: self.checked(service_id, future))
+
+    def checked(self, service_id, future):
+        """Completion callback of the ping to a suspected service."""
+        if future.exception() is None:
+            self.last_seen[service_id] = time.monotonic()
+        else:
+            self.evict(service_id)
+
+    def state(self):
+        """Return the known services per type, with the seconds since their last announcement."""
+        now = time.monotonic()
+        with self.lock:
+            return {
+                service_type: {
+                    service_id: {
+                        "proxy": str(proxy),
+                        "last_seen": now - self.last_seen.get(service_id, now),
+                    }
+                    for service_id, proxy in list(registry.items())
+                }
+                for service_type, registry in self.registries().items()
+            }
+
+    def run_checks(self):
+        """Check the known services every CHECK_INTERVAL seconds until stopped."""
+        while not self.checks_stopped.wait(CHECK_INTERVAL):
             try:
-                self.catalogs[catalog].ice_ping()
-            except Ice.LocalException:
-                del self.catalogs[catalog]
-                self.known_ids.remove(catalog)
-        # pylint: disable=C0201
-        for provider in self.providers.keys():
+                self.checkServices()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Error checking services")
+            logging.debug("Known services: %s", self.state())
+
+    def start_checks(self):
+        """Start the background failure detector."""
+        self.checks_thread = threading.Thread(target=self.run_checks, daemon=True)
+        self.checks_thread.start()
+
+    def stop_checks(self):
+        """Stop the background failure detector."""
+        self.checks_stopped.set()
+
+
+def payload_size(value):
+    """Estimate the size in bytes of the data of an invocation."""
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (bool, int, float)):
+        return 8
+    if isinstance(value, dict):
+        return sum(payload_size(key) + payload_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sum(payload_size(item) for item in value)
+    if hasattr(value, "__dict__"):
+        return payload_size(vars(value))
+    return 0
+
+
+class DataTransfers:
+    """Runs the transfers of data between services asynchronously.
+
+    Each transfer is an asynchronous invocation (AMI) with a timeout. At most
+    `max_in_flight` of them run at the same time and the rest wait in a
+    queue, so the thread that requests a transfer (usually an IceStorm
+    dispatch of `newService`) never blocks. The number, failures, estimated
+    size and duration of the transfers are recorded.
+    """
+
+    def __init__(self, max_in_flight=MAX_TRANSFERS, timeout=TRANSFER_TIMEOUT):
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.queue = deque()
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.count = 0
+        self.failures = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def send(self, proxy, operation, args, on_done=None):
+        """Queue the invocation of `operation` on `proxy` with `args`.
+
+        The optional `on_done` callable receives the result and the
+        exception (one of them None) when the invocation finishes.
+        """
+        with self.lock:
+            self.queue.append((proxy, operation, args, on_done))
+        self.pump()
+
+    def pump(self):
+        """Start queued transfers while there is room for them."""
+        while True:
+            with self.lock:
+                if self.in_flight >= self.max_in_flight or not self.queue:
+                    return
+                transfer = self.queue.popleft()
+                self.in_flight += 1
+            self.begin(*transfer)
+
+    def begin(self, proxy, operation, args, on_done):
+        """Start an asynchronous invocation."""
+        start = time.monotonic()
+        size = payload_size(args)
+        try:
+            invocation = getattr(proxy.ice_invocationTimeout(self.timeout), operation + "Async")
+            future = invocation(*args)
+        except Exception as ex:  # pylint: disable=broad-except
+            self.finished(proxy, operation, size, start, on_done, None, ex)
+            return
+        future.add_done_callback(
+            lambda future: self.finished(
+                proxy, operation, size, start, on_done,
+                future.result() if future.exception() is None else None,
+                future.exception(),
+            )
+        )
+
+    def finished(self, proxy, operation, size, start, on_done, result, exception):
+        """Record a finished transfer and start the next one."""
+        elapsed = time.monotonic() - start
+        size += payload_size(result)
+        with self.lock:
+            self.in_flight -= 1
+            self.count += 1
+            self.bytes += size
+            self.seconds += elapsed
+            if exception is not None:
+                self.failures += 1
+        if exception is None:
+            logging.info("%s with %s: %d bytes in %.3f s", operation, proxy, size, elapsed)
+        else:
+            logging.warning("%s with %s failed after %.3f s: %s", operation, proxy, elapsed, exception)
+        if on_done:
             try:
-                self.providers[provider].ice_ping()
-            except Ice.LocalException:
-                del self.providers[provider]
-                self.known_ids.remove(provider)
+                on_done(result, exception)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Error handling the result of %s", operation)
+        self.pump()
+
+    def stats(self):
+        """Return a summary of the transfers."""
+        return (f"{self.count} transfers, {self.failures} failed, "
+                f"{self.bytes} bytes, {self.seconds:.3f} s")
 
 
 class ServiceAnnouncementsSender:
     """The instances send the announcement events periodically to the topic."""
 
-    def __init__(self, topic, service_id, servant_proxy):
+    def __init__(self, topic, service_id, servant_proxy, service_type=None, status=None):
         """Initialize a ServiceAnnoucentsSender.
         The `topic` argument should be a IceStorm.TopicPrx object.
         The `service_id` should be the unique identifier of the announced proxy
         The `servant_proxy` should be a object proxy to the servant.
+        The optional `service_type` should be the type id of the servant, for
+        example "::IceFlix::Main". It is sent in the context of the events so
+        the listeners do not need to ask the service for its type.
+        The optional `status` should be a callable returning a dict of strings
+        added to the context of every announcement, for example the spare
+        capacity of the service.
         """
         self.publisher = IceFlix.ServiceAnnouncementsPrx.uncheckedCast(
             topic.getPublisher(),
         )
         self.service_id = service_id
         self.proxy = servant_proxy
+        self.context = {SERVICE_TYPE_CONTEXT: service_type} if service_type else {}
+        self.status = status
         self.timer = None
 
     def start_service(self):
         """Start sending the initial announcement."""
-        self.publisher.newService(self.proxy, self.service_id)
+        self.publisher.newService(self.proxy, self.service_id, self.context)
         self.timer = threading.Timer(3.0, self.announce)
         self.timer.start()
 
     def announce(self):
         """Start sending the announcements."""
         self.timer = None
-        self.publisher.announce(self.proxy, self.service_id)
-        self.timer = threading.Timer(10.0, self.announce)
+        context = dict(self.context)
+        if self.status:
+            context.update(self.status())
+        self.publisher.announce(self.proxy, self.service_id, context)
+        self.timer = threading.Timer(ANNOUNCE_INTERVAL, self.announce)
         self.timer.daemon = True
         self.timer.start()
 
@@ -12,12 +12,12 @@
 from distutils.log import error
 from time import sleep
 import logging
+import mmap
 import uuid
 import random
 import os
 import sys
 import string
-import hashlib
 import threading
 import time
 
@@ -30,15 +30,80 @@ except ImportError:
     Ice.loadSlice(os.path.join(os.path.dirname(__file__), "iceflix.ice"))
     import IceFlix
 from service_announcement import (
+    SPARE_CAPACITY_CONTEXT,
     ServiceAnnouncementsListener,
     ServiceAnnouncementsSender,
 )
+from media_hashing import (
+    MANIFEST_PATH,
+    MANIFEST_PATH_PROPERTY,
+    SCAN_WORKERS_PROPERTY,
+    MediaManifest,
+    MediaScanner,
+)
+from media_upload import (
+    UPLOAD_CHUNK_SIZE,
+    UPLOAD_CHUNK_SIZE_PROPERTY,
+    UPLOAD_SHA256_CONTEXT,
+    UPLOAD_WINDOW,
+    UPLOAD_WINDOW_PROPERTY,
+    UploadSessions,
+    is_temp_file,
+    receive_upload,
+)
+from media_http import (
+    HTTP_HOST,
+    HTTP_HOST_PROPERTY,
+    HTTP_PORT,
+    HTTP_PORT_PROPERTY,
+    HTTP_SERVER_PROPERTY,
+    MAX_TRANSFERS,
+    MAX_TRANSFERS_PROPERTY,
+    MediaHTTPServer,
+)
 from rtsputils import(
-    RTSPEmitter
+    MULTICAST_BASE,
+    MULTICAST_BASE_PROPERTY,
+    MULTICAST_PORT,
+    MULTICAST_PORT_PROPERTY,
+    RTSPEmitter,
+    SHARED_STREAMS_PROPERTY,
+    SharedEmitters,
+    TRANSCODE_CACHE_DIR,
+    TRANSCODE_CACHE_DIR_PROPERTY,
+    TRANSCODE_CACHE_SIZE,
+    TRANSCODE_CACHE_SIZE_PROPERTY,
+    TranscodeCache,
+)
+from auth_batching import (
+    AuthBatcher,
+    BATCH_WINDOW,
+    BATCH_WINDOW_PROPERTY,
+)
+from token_signing import (
+    REVOKED_AT_CONTEXT,
+    TokenVerifier,
+    load_key,
 )
 
-CHUNK_SIZE = 10
 APP = None
+# Seconds a client has to refresh a revoked token before its stream stops
+REAUTH_TIMEOUT = 5.0
+# Stream leases and limits, 0 disables them
+SESSION_TIMEOUT = 60.0
+REAP_INTERVAL = 5.0
+MAX_STREAMS = 100
+MAX_STREAMS_PER_USER = 3
+SESSION_TIMEOUT_PROPERTY = "StreamProvider.SessionTimeout"
+MAX_STREAMS_PROPERTY = "StreamProvider.MaxStreams"
+MAX_STREAMS_PER_USER_PROPERTY = "StreamProvider.MaxStreamsPerUser"
+# Admission of new pipelines: running pipelines and load average per CPU
+MAX_PIPELINES = 8
+MAX_LOAD = 0.9
+MAX_PIPELINES_PROPERTY = "StreamProvider.MaxPipelines"
+MAX_LOAD_PROPERTY = "StreamProvider.MaxLoad"
+# Bytes returned by one MediaReader.read, below the default Ice.MessageSizeMax
+MAX_READ_SIZE = 512 * 1024
 def getTopic(communicator, topic_name):
     """Method to create streaming topic."""
     topic_manager = IceStorm.TopicManagerPrx.checkedCast(
@@ -58,61 +123,128 @@ class StreamProvider(IceFlix.StreamProvider):
         self.media_available = {}
         self.servant_serv_announ = None
         self.stream_announ_prx = None
+        self.verifier = TokenVerifier()
+        self.auth_batcher = AuthBatcher(self.getAuthenticator)
+        self.manifest = None
+        self.scanner = None
+        self.scan_lock = threading.Lock()
+        self.upload_chunk_size = UPLOAD_CHUNK_SIZE
+        self.upload_window = UPLOAD_WINDOW
+        self.upload_sessions = None
+        self.transcode_cache = None
+        self.shared_emitters = None
+        self.http_server = None
+        self.revocations = Revocations(self)
+        self.sessions = StreamSessions()
+        self.admission = AdmissionControl(self.activePipelines)
+        self.stream_sync_prx = None
     def share_data_with(self, service):
-        """Share the current database with an incoming service."""
-        service.updateDB(None, self.service_id)
+        """Stream providers have no database to share."""
 
     def readMedia(self):
-        """Method to read the system media."""
-        iterator = os.scandir("./resources")
-        while 1:
+        """Method to read the system media.
+
+        Ids come from the manifest, only new or modified files are hashed
+        in parallel. Every media is announced and served as soon as its id
+        is known, before the whole scan finishes.
+        """
+        with self.scan_lock:
+            start = time.monotonic()
+            media_paths = [media.path for media in os.scandir("./resources")
+                           if not is_temp_file(media.name)]
+            self.scanner.scan(media_paths, self.addMedia)
+            self.manifest.prune(media_paths)
             try:
-                media = iterator.__next__()
-                media_path = media.path
-                file = open(media_path, "rb")
-                media_content = file.read()
-                media_id = hashlib.sha256(str(media_content).encode()).hexdigest()
-                media_name = media_path.split("/")[2].split(".")[0]
-                self.stream_announ_prx.newMedia(media_id, media_name, self.service_id)
-                self.media_available[media_id] = media_name
-            except StopIteration:
-                break
-            except Exception:
-                error("Error durante el anunciamento de medios")
+                self.manifest.save()
+            except OSError:
+                error("Error al guardar el manifiesto de medios")
+            logging.info("Media ready in %.3f s: %s",
+                         time.monotonic() - start, self.scanner.progress())
+
+    def addMedia(self, media_path, media_id):
+        """Serve and announce a media file."""
+        media_name = media_path.split("/")[2].split(".")[0]
+        self.media_available[media_id] = media_name
+        try:
+            self.stream_announ_prx.newMedia(media_id, media_name, self.service_id)
+        except Exception:
+            error("Error durante el anunciamento de medios")
 
-    def getStream(self, media_id, user_token, current=None):
-        """Used to get the stream."""
-        #Get authenticator
-        authorized = False
+    def getAuthenticator(self):
+        """Obtain an authenticator through a random main."""
         main_prx = random.choice(list(self.servant_serv_announ.mains.values()))
+        return main_prx.getAuthenticator()
+
+    def checkToken(self, user_token):
+        """Obtain the user of a token, None if it is not valid.
+
+        Signed tokens are checked locally, the rest are batched with other
+        pending checks to the authenticator.
+        """
+        if self.verifier.accepts(user_token):
+            return self.verifier.whois(user_token)
         try:
-            auth_prx = main_prx.getAuthenticator()
-            authorized = auth_prx.isAuthorized(user_token)
+            return self.auth_batcher.whois(user_token) or None
         except IceFlix.TemporaryUnavailable:
             error("Servicio de autenticación no disponible")
+        return None
+
+    def activePipelines(self):
+        """Number of streaming processes running in this node."""
+        with self.sessions.lock:
+            controllers = list(self.sessions.sessions)
+        private = sum(1 for controller in controllers
+                      if getattr(controller, "emitter", None) is not None
+                      and controller.emitter.running)
+        shared = len(self.shared_emitters.streams) if self.shared_emitters else 0
+        return private + shared
 
-        if not authorized:
+    def getStream(self, media_id, user_token, current=None):
+        """Used to get the stream."""
+        #Get user
+        user_name = self.checkToken(user_token)
+        if user_name is None:
             raise IceFlix.Unauthorized()
 
-        if not self.isAvailable(media_id):
+        media_path = self.mediaPath(media_id)
+        if media_path is None:
             raise IceFlix.WrongMediaId(media_id)
+        self.admission.check()
 
-        try:
-            user_name = auth_prx.whois(user_token)
-        except IceFlix.Unauthorized:
-            raise IceFlix.Unauthorized()
-        media_path = "./resources/"+self.media_available[media_id]+".mp4"
-        servant_stream_controller = StreamController(user_token, main_prx, media_path)
-        stream_controller_prx = current.adapter.addWithUUID(servant_stream_controller)
+        servant_stream_controller = StreamController(user_token, user_name, media_path, self)
+        stream_controller_prx = self.sessions.open(servant_stream_controller, current.adapter)
         stream_controller_prx = IceFlix.StreamControllerPrx.uncheckedCast(stream_controller_prx)
-
-        servant_revocations = Revocations(user_token, user_name, self.servant_serv_announ)
-        revocations_topic = getTopic(APP.communicator(), "Revocations")
-        revocations_prx = current.adapter.addWithUUID(servant_revocations)
-        revocations_topic.subscribeAndGetPublisher({}, revocations_prx)
+        self.revocations.add(servant_stream_controller)
 
         return stream_controller_prx
 
+    def getReader(self, media_id, user_token, current=None):
+        """Used to read a media by ranges instead of streaming it."""
+        user_name = self.checkToken(user_token)
+        if user_name is None:
+            raise IceFlix.Unauthorized()
+
+        media_path = self.mediaPath(media_id)
+        if media_path is None:
+            raise IceFlix.WrongMediaId(media_id)
+        try:
+            servant_media_reader = MediaReader(user_token, user_name, media_id, media_path, self)
+        except OSError:
+            error("Error al abrir el medio")
+            raise IceFlix.TemporaryUnavailable()
+        media_reader_prx = self.sessions.open(servant_media_reader, current.adapter)
+        self.revocations.add(servant_media_reader)
+        if self.http_server is not None:
+            self.http_server.register(servant_media_reader.session_id, servant_media_reader)
+        return IceFlix.MediaReaderPrx.uncheckedCast(media_reader_prx)
+
+    def mediaPath(self, media_id):
+        """Path of a media file, None if the media is not available."""
+        media_name = self.media_available.get(media_id)
+        if media_name is None:
+            return None
+        return "./resources/"+media_name+".mp4"
+
     def isAvailable(self, media_id, current=None):
         """Check if media is available."""
         if media_id in self.media_available.keys():
@@ -123,44 +255,41 @@ class StreamProvider(IceFlix.StreamProvider):
         """Method to reannounce the media to the client."""
         if not srv_id in self.servant_serv_announ.known_ids:
             raise IceFlix.UnknownService()
-        self.readMedia()
+        threading.Thread(target=self.readMedia, daemon=True).start()
 
     def uploadMedia(self, file_name, uploader, admin_token, current=None):
-        """Method to upload new media."""
+        """Method to upload new media.
+
+        The file is pulled one chunk at a time unless the caller sends its
+        SHA-256 in the UPLOAD_SHA256_CONTEXT entry, see media_upload.
+        """
         logging.info(f"Receiving medio {file_name}")
-        is_admin = False
-        main_prx = random.choice(list(self.servant_serv_announ.mains.values()))
-        try:
-            is_admin = main_prx.isAdmin(admin_token)
-        except Ice.LocalException:
-            error("Servicio principal no disponible")
-        if not is_admin:
-            raise IceFlix.Unauthorized()
+        self.checkAdmin(admin_token)
         media_title = file_name.split("/")[-1]
         media_size = os.path.getsize(file_name)
         media_path = "./resources/"+media_title
 
         if not os.path.exists(media_path):
-            file_bytes = bytes()
-            with open(media_path, "wb") as file:
-                while True:
-                    try:
-                        chunk = uploader.receive(CHUNK_SIZE)
-                        file.write(chunk)
-                        file_bytes += chunk
-                        if len(file_bytes) >= media_size:
-                            uploader.close()
-                            break
-                    except Exception:
-                        raise IceFlix.UploadError()
-            media_id = hashlib.sha256(str(file_bytes).encode()).hexdigest()
+            start = time.monotonic()
+            expected = current.ctx.get(UPLOAD_SHA256_CONTEXT, "").lower() if current else ""
+            media_id, sha256 = receive_upload(uploader, media_size, media_path,
+                                              self.upload_chunk_size, self.upload_window,
+                                              expected)
+            elapsed = time.monotonic() - start
+            logging.info("Uploaded %s: %d bytes in %.3f s (%.1f MB/s)", media_title,
+                         media_size, elapsed, media_size / 1e6 / max(elapsed, 1e-9))
+            try:
+                uploader.close()
+            except Ice.LocalException:
+                error("Error al cerrar el MediaUploader")
+            self.manifest.update(media_path, os.stat(media_path), media_id, sha256)
             media_name = media_title.split(".")[0]
             self.stream_announ_prx.newMedia(media_id, media_name, self.service_id)
             self.media_available[media_id] = media_name
             return media_id
 
-    def deleteMedia(self, media_id, admin_token, current=None):
-        """Method to delete media."""
+    def checkAdmin(self, admin_token):
+        """Raise Unauthorized unless the token is the administrator's."""
         is_admin = False
         main_prx = random.choice(list(self.servant_serv_announ.mains.values()))
         try:
@@ -169,34 +298,77 @@ class StreamProvider(IceFlix.StreamProvider):
             error("Servicio principal no disponible")
         if not is_admin:
             raise IceFlix.Unauthorized()
+
+    def beginUpload(self, file_name, size, sha256, admin_token, current=None):
+        """Begin or resume a resumable upload."""
+        self.checkAdmin(admin_token)
+        session = self.upload_sessions.begin(file_name, size, sha256)
+        if session.media_id:
+            self.addMedia(session.destination, session.media_id)
+        return session.state()
+
+    def writeUpload(self, session_id, offset, data, current=None):
+        """Store a chunk of a resumable upload."""
+        return self.upload_sessions.write(session_id, offset, data)
+
+    def queryUpload(self, session_id, current=None):
+        """Return the bytes stored of a resumable upload."""
+        return self.upload_sessions.get(session_id).offset
+
+    def commitUpload(self, session_id, current=None):
+        """Finish a resumable upload and announce the media."""
+        media_id = self.upload_sessions.commit(session_id)
+        self.addMedia(self.upload_sessions.get(session_id).destination, media_id)
+        return media_id
+
+    def deleteMedia(self, media_id, admin_token, current=None):
+        """Method to delete media."""
+        self.checkAdmin(admin_token)
         del self.media_available[media_id]
         self.stream_announ_prx.removedMedia(media_id, self.service_id)
 
 class StreamController(IceFlix.StreamController):
     """Class used to control the stream player."""
-    def __init__(self, user_token, main_prx, media) -> None:
+    def __init__(self, user_token, user_name, media, provider) -> None:
         self.emitter = None
+        self.shared = None
         self.media = media
-        self.main_prx = main_prx
+        self.provider = provider
         self.user_token = user_token
+        self.user_name = user_name
+        self.lock = threading.Lock()
+
+    def isAuthorized(self, user_token):
+        """Check the token through the provider."""
+        return self.provider.checkToken(user_token) is not None
 
     def getSDP(self, user_token, port, current=None):
         """Used to start the RTSP."""
-        authorized = False
-        try:
-            auth_prx = self.main_prx.getAuthenticator()
-            authorized = auth_prx.isAuthorized(user_token)
-        except IceFlix.TemporaryUnavailable:
-            error("Servicio de autenticación no disponible")
-
-        if not authorized:
+        if not self.isAuthorized(user_token):
             raise IceFlix.Unauthorized()
-        self.emitter = RTSPEmitter(self.media, "127.0.0.1", port)
-        self.emitter.start()
-        return self.emitter.playback_uri
+        self.provider.sessions.touch(self)
+        shared_emitters = self.provider.shared_emitters
+        with self.lock:
+            self.release()
+            reserved = shared_emitters is None or self.media not in shared_emitters.streams
+            if reserved:
+                self.provider.admission.admit()
+            try:
+                if shared_emitters is not None:
+                    self.shared = shared_emitters.join(self.media)
+                    if self.shared is not None:
+                        return self.shared.emitter.playback_uri
+                self.emitter = RTSPEmitter(
+                    self.media, "127.0.0.1", port, self.provider.transcode_cache)
+                self.emitter.start()
+                return self.emitter.playback_uri
+            finally:
+                if reserved:
+                    self.provider.admission.release()
 
     def getSyncTopic(self, current=None):
         """Method that syncs to the topic."""
+        self.provider.sessions.touch(self)
         length = 10
         topic = ''.join(random.SystemRandom().choice(
             string.ascii_letters + string.digits) for _ in range(length))
@@ -204,53 +376,361 @@ class StreamController(IceFlix.StreamController):
 
     def refreshAuthentication(self, user_token, current=None):
         """Method to authenticate."""
-        authorized = False
-        try:
-            auth_prx = self.main_prx.getAuthenticator()
-            authorized = auth_prx.isAuthorized(user_token)
-        except IceFlix.TemporaryUnavailable:
-            error("Servicio de autenticación no disponible")
-
-        if not authorized:
+        if not self.isAuthorized(user_token):
             self.stop()
             raise IceFlix.Unauthorized()
+        self.provider.revocations.update_token(self, user_token)
+        self.provider.sessions.touch(self)
         self.user_token = user_token
 
+    def keepAlive(self, current=None):
+        """Renew the lease of the stream."""
+        self.provider.sessions.touch(self)
+
+    def playing(self):
+        """Check if the stream of the controller is still being emitted."""
+        with self.lock:
+            if self.shared is not None:
+                return self.shared.emitter.running
+            return self.emitter is not None and self.emitter.running
+
+    def revoked(self):
+        """Stop unless the client refreshes the token in REAUTH_TIMEOUT seconds."""
+        old_token = self.user_token
+        timer = threading.Timer(REAUTH_TIMEOUT, self.checkRefreshed, args=(old_token,))
+        timer.daemon = True
+        timer.start()
+
+    def checkRefreshed(self, old_token):
+        """Stop if the token was not refreshed after a revocation."""
+        if self.user_token == old_token:
+            logging.info("Stopping stream of %s, token not refreshed", self.user_name)
+            self.stop()
+
     def stop(self, current=None):
         """Method to stop the current playing media"""
-        self.emitter.stop()
-
-class Revocations(IceFlix.Revocations):
-    """Used to revoke users and tokens."""
-    def __init__(self, user_token, user_name, servant_serv_announ) -> None:
+        self.provider.revocations.remove(self)
+        self.provider.sessions.close(self)
+        with self.lock:
+            self.release()
+
+    def release(self):
+        """Leave the shared stream and stop the private emitter, if any."""
+        if self.shared is not None:
+            self.provider.shared_emitters.leave(self.media, self.shared)
+            self.shared = None
+        if self.emitter is not None:
+            self.emitter.stop()
+            self.emitter = None
+
+class MediaReader(IceFlix.MediaReader):
+    """Class used to read a media by ranges.
+
+    The file is mapped in memory once and every read slices the map, which
+    copies the range into a bytes object in one go. Ice marshals bytes
+    directly, views of the map would be marshalled byte by byte. Readers are tracked like
+    the stream controllers: they count towards the stream limits, hold a
+    lease renewed by every call and are stopped when their token is revoked
+    and not refreshed. A reader is also the session of its HTTP transfers,
+    which the HTTP server limits apart from the transcoding pipelines.
+    """
+    def __init__(self, user_token, user_name, media_id, media, provider) -> None:
+        self.session_id = str(uuid.uuid4())
+        self.media_id = media_id
+        self.media_path = media
+        self.provider = provider
         self.user_token = user_token
         self.user_name = user_name
-        self.servant_serv_announ = servant_serv_announ
-        self.stream_sync_topic = getTopic(StreamingApp().communicator(), "StreamSync")
-        stream_sync_prx = self.stream_sync_topic.getPublisher()
-        self.stream_sync_prx = IceFlix.StreamSyncPrx.uncheckedCast(stream_sync_prx)
+        self.data = b""
+        with open(media, "rb") as media_file:
+            if os.fstat(media_file.fileno()).st_size:
+                self.data = mmap.mmap(media_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def getSize(self, current=None):
+        """Size of the media in bytes."""
+        self.provider.sessions.touch(self)
+        return len(self.data)
+
+    def read(self, offset, size, current=None):
+        """Return up to `size` bytes from `offset`."""
+        self.provider.sessions.touch(self)
+        if offset < 0 or size <= 0:
+            return b""
+        return self.data[offset:offset + min(size, MAX_READ_SIZE)]
+
+    def getUrl(self, current=None):
+        """URL of the media in the HTTP server of the provider."""
+        self.provider.sessions.touch(self)
+        if self.provider.http_server is None:
+            return ""
+        return self.provider.http_server.url(self.media_id, self.session_id)
+
+    def authorize(self, user_token):
+        """Check the token of an HTTP request and renew the lease."""
+        if self.provider.checkToken(user_token) != self.user_name:
+            return False
+        self.provider.sessions.touch(self)
+        return True
+
+    def refreshAuthentication(self, user_token, current=None):
+        """Method to authenticate."""
+        if self.provider.checkToken(user_token) is None:
+            self.stop()
+            raise IceFlix.Unauthorized()
+        self.provider.revocations.update_token(self, user_token)
+        self.provider.sessions.touch(self)
+        self.user_token = user_token
+
+    def keepAlive(self, current=None):
+        """Renew the lease of the reader."""
+        self.provider.sessions.touch(self)
+
+    def playing(self):
+        """Readers have no emitter, they only live while their lease is renewed."""
+        return False
+
+    def revoked(self):
+        """Stop unless the client refreshes the token in REAUTH_TIMEOUT seconds."""
+        old_token = self.user_token
+        timer = threading.Timer(REAUTH_TIMEOUT, self.checkRefreshed, args=(old_token,))
+        timer.daemon = True
+        timer.start()
+
+    def checkRefreshed(self, old_token):
+        """Stop if the token was not refreshed after a revocation."""
+        if self.user_token == old_token:
+            logging.info("Closing reader of %s, token not refreshed", self.user_name)
+            self.stop()
+
+    def stop(self, current=None):
+        """Close the reader, the map is released once no read is using it."""
+        self.provider.revocations.remove(self)
+        self.provider.sessions.close(self)
+        if self.provider.http_server is not None:
+            self.provider.http_server.unregister(self.session_id)
+        self.data = b""
+
+class AdmissionControl:
+    """Decides if the node can start one more streaming pipeline.
+
+    The node is over budget when the running pipelines reach the configured
+    capacity or when the load average per CPU reaches `max_load`. Requests
+    are then rejected with TemporaryUnavailable before any work is done.
+    A pipeline about to start holds a reserved slot until it is counted by
+    `pipelines`, so concurrent requests cannot overshoot the capacity.
+    The spare capacity is announced so other services can prefer less
+    loaded providers.
+    """
+    def __init__(self, pipelines, max_pipelines=MAX_PIPELINES, max_load=MAX_LOAD) -> None:
+        self.pipelines = pipelines
+        self.max_pipelines = max_pipelines
+        self.max_load = max_load
+        self.reserved = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def load():
+        """Load average of the last minute per CPU."""
+        try:
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+        except OSError:
+            return 0.0
+
+    def spare_capacity(self):
+        """Number of pipelines the node can still start."""
+        if self.max_load and self.load() >= self.max_load:
+            return 0
+        return max(0, self.max_pipelines - self.pipelines() - self.reserved)
+
+    def check(self):
+        """Raise TemporaryUnavailable if the node is over budget."""
+        if self.spare_capacity() <= 0:
+            logging.warning("Stream rejected, node over budget")
+            raise IceFlix.TemporaryUnavailable()
+
+    def admit(self):
+        """Reserve a slot for a new pipeline or raise TemporaryUnavailable.
+
+        The slot must be released once the pipeline runs, or if it could
+        not be started.
+        """
+        with self.lock:
+            self.check()
+            self.reserved += 1
+
+    def release(self):
+        """Give back a reserved slot."""
+        with self.lock:
+            self.reserved -= 1
+
+    def status(self):
+        """Announcement context with the spare capacity."""
+        return {SPARE_CAPACITY_CONTEXT: str(self.spare_capacity())}
+
+class StreamSessions:
+    """Tracks the StreamControllers of a provider.
+
+    Every controller holds a lease renewed by any of its calls. Controllers
+    whose lease expired are stopped once their emitter is no longer running,
+    which removes their servant from the adapter, so clients that do not
+    call keepAlive are not cut off mid-playback. The number of concurrent
+    streams is limited per node and per user.
+    """
+    def __init__(self, timeout=SESSION_TIMEOUT, max_streams=MAX_STREAMS,
+                 max_per_user=MAX_STREAMS_PER_USER) -> None:
+        self.timeout = timeout
+        self.max_streams = max_streams
+        self.max_per_user = max_per_user
+        self.sessions = {}
+        self.per_user = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def open(self, controller, adapter):
+        """Add a controller to the adapter if the limits allow it."""
+        with self.lock:
+            if self.max_streams and len(self.sessions) >= self.max_streams:
+                logging.warning("Stream limit reached")
+                raise IceFlix.TemporaryUnavailable()
+            streams = self.per_user.get(controller.user_name, 0)
+            if self.max_per_user and streams >= self.max_per_user:
+                logging.warning("Stream limit reached by %s", controller.user_name)
+                raise IceFlix.TemporaryUnavailable()
+            proxy = adapter.addWithUUID(controller)
+            self.sessions[controller] = [adapter, proxy.ice_getIdentity(), time.monotonic()]
+            self.per_user[controller.user_name] = streams + 1
+        return proxy
+
+    def touch(self, controller):
+        """Renew the lease of a controller."""
+        with self.lock:
+            session = self.sessions.get(controller)
+            if session is not None:
+                session[2] = time.monotonic()
+
+    def close(self, controller):
+        """Forget a controller and remove its servant."""
+        with self.lock:
+            session = self.sessions.pop(controller, None)
+            if session is None:
+                return
+            self.per_user[controller.user_name] -= 1
+            if not self.per_user[controller.user_name]:
+                del self.per_user[controller.user_name]
+        adapter, identity, _ = session
+        try:
+            adapter.remove(identity)
+        except (Ice.NotRegisteredException, Ice.ObjectAdapterDeactivatedException):
+            pass
+
+    def reap(self):
+        """Stop the controllers whose lease expired and that are not playing."""
+        deadline = time.monotonic() - self.timeout
+        with self.lock:
+            expired = [controller for controller, session in self.sessions.items()
+                       if session[2] < deadline]
+        for controller in expired:
+            if controller.playing():
+                continue
+            logging.info("Stream of %s expired", controller.user_name)
+            controller.stop()
+
+    def run(self):
+        """Reap expired streams every REAP_INTERVAL seconds until stopped."""
+        while not self.stopped.wait(REAP_INTERVAL):
+            try:
+                self.reap()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Error reaping streams")
+
+    def start(self):
+        """Start reaping expired streams, unless leases are disabled."""
+        if self.timeout:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Stop reaping and stop every stream."""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        with self.lock:
+            controllers = list(self.sessions)
+        for controller in controllers:
+            controller.stop()
+
+class Revocations(IceFlix.Revocations):
+    """Single Revocations subscriber of a provider.
+
+    Controllers are indexed by token and by user, so every event only
+    reaches the streams it affects. Revocations also feed the deny list of
+    the signed tokens verifier.
+    """
+    def __init__(self, provider) -> None:
+        self.provider = provider
+        self.by_token = {}
+        self.by_user = {}
+        self.lock = threading.Lock()
+
+    def add(self, controller):
+        """Start tracking a controller."""
+        with self.lock:
+            self.by_token.setdefault(controller.user_token, set()).add(controller)
+            self.by_user.setdefault(controller.user_name, set()).add(controller)
+
+    def remove(self, controller):
+        """Stop tracking a controller."""
+        with self.lock:
+            self._discard(self.by_token, controller.user_token, controller)
+            self._discard(self.by_user, controller.user_name, controller)
+
+    def update_token(self, controller, user_token):
+        """Move a controller to the token it was refreshed with."""
+        with self.lock:
+            if controller not in self.by_user.get(controller.user_name, ()):
+                return
+            self._discard(self.by_token, controller.user_token, controller)
+            self.by_token.setdefault(user_token, set()).add(controller)
+
+    @staticmethod
+    def _discard(index, key, controller):
+        controllers = index.get(key)
+        if controllers is None:
+            return
+        controllers.discard(controller)
+        if not controllers:
+            del index[key]
+
+    def notify(self, controllers):
+        """Ask the clients for new tokens and wait for the affected streams."""
+        if not controllers:
+            return
+        try:
+            self.provider.stream_sync_prx.requestAuthentication()
+        except Ice.LocalException:
+            error("Error al solicitar la reautenticación")
+        for controller in controllers:
+            controller.revoked()
 
     def revokeToken(self, user_token, srv_id, current=None):
         """Method to revoke token."""
-        if srv_id in self.servant_serv_announ.known_ids:
-            if user_token == self.user_token:
-                old_token = self.user_token
-                self.stream_sync_prx.requestAuthentication()
-                threading.Timer(5.0, None)
-                new_token = self.user_token
-                if new_token == old_token:
-                    self.stream_sync_prx.stop()
+        self.provider.verifier.revoke_token(user_token)
+        if srv_id not in self.provider.servant_serv_announ.known_ids:
+            return
+        with self.lock:
+            controllers = list(self.by_token.get(user_token, ()))
+        self.notify(controllers)
 
     def revokeUser(self, user, srv_id, current=None):
         """Method to revoke user."""
-        if srv_id in self.servant_serv_announ.known_ids:
-            if user == self.user_name:
-                old_token = self.user_token
-                self.stream_sync_prx.requestAuthentication()
-                threading.Timer(5.0, None)
-                new_token = self.user_token
-                if new_token == old_token:
-                    self.stream_sync_prx.stop()
+        self.provider.verifier.revoke_user(
+            user, current.ctx.get(REVOKED_AT_CONTEXT) if current else None)
+        if srv_id not in self.provider.servant_serv_announ.known_ids:
+            return
+        with self.lock:
+            controllers = list(self.by_user.get(user, ()))
+        self.notify(controllers)
 
 class StreamingApp(Ice.Application):
     """Streaming app init."""
@@ -277,6 +757,8 @@ class StreamingApp(Ice.Application):
             topic,
             self.servant.service_id,
             self.proxy,
+            self.servant.ice_staticId(),
+            self.servant.admission.status,
         )
 
         self.subscriber = ServiceAnnouncementsListener(
@@ -285,6 +767,7 @@ class StreamingApp(Ice.Application):
 
         subscriber_prx = self.adapter.addWithUUID(self.subscriber)
         topic.subscribeAndGetPublisher({}, subscriber_prx)
+        self.subscriber.start_checks()
     def run(self, args):
         """Streaming class initialization."""
         broker = self.communicator()
@@ -304,14 +787,69 @@ class StreamingApp(Ice.Application):
 
         self.servant.servant_serv_announ = self.subscriber
         self.servant.stream_announ_prx = stream_announcements_pub
+        self.servant.manifest = MediaManifest(broker.getProperties().getPropertyWithDefault(
+            MANIFEST_PATH_PROPERTY, MANIFEST_PATH))
+        self.servant.upload_chunk_size = broker.getProperties().getPropertyAsIntWithDefault(
+            UPLOAD_CHUNK_SIZE_PROPERTY, UPLOAD_CHUNK_SIZE)
+        self.servant.upload_window = broker.getProperties().getPropertyAsIntWithDefault(
+            UPLOAD_WINDOW_PROPERTY, UPLOAD_WINDOW)
+        self.servant.transcode_cache = TranscodeCache(
+            broker.getProperties().getPropertyWithDefault(
+                TRANSCODE_CACHE_DIR_PROPERTY, TRANSCODE_CACHE_DIR),
+            broker.getProperties().getPropertyAsIntWithDefault(
+                TRANSCODE_CACHE_SIZE_PROPERTY, TRANSCODE_CACHE_SIZE) << 20)
+        if broker.getProperties().getPropertyAsIntWithDefault(SHARED_STREAMS_PROPERTY, 0):
+            self.servant.shared_emitters = SharedEmitters(
+                broker.getProperties().getPropertyWithDefault(
+                    MULTICAST_BASE_PROPERTY, MULTICAST_BASE),
+                broker.getProperties().getPropertyAsIntWithDefault(
+                    MULTICAST_PORT_PROPERTY, MULTICAST_PORT),
+                cache=self.servant.transcode_cache)
+        self.servant.sessions.timeout = broker.getProperties().getPropertyAsIntWithDefault(
+            SESSION_TIMEOUT_PROPERTY, int(SESSION_TIMEOUT))
+        self.servant.sessions.max_streams = broker.getProperties().getPropertyAsIntWithDefault(
+            MAX_STREAMS_PROPERTY, MAX_STREAMS)
+        self.servant.sessions.max_per_user = broker.getProperties().getPropertyAsIntWithDefault(
+            MAX_STREAMS_PER_USER_PROPERTY, MAX_STREAMS_PER_USER)
+        self.servant.sessions.start()
+        self.servant.admission.max_pipelines = broker.getProperties().getPropertyAsIntWithDefault(
+            MAX_PIPELINES_PROPERTY, MAX_PIPELINES)
+        self.servant.admission.max_load = float(broker.getProperties().getPropertyWithDefault(
+            MAX_LOAD_PROPERTY, str(MAX_LOAD)))
+        if broker.getProperties().getPropertyAsIntWithDefault(HTTP_SERVER_PROPERTY, 0):
+            self.servant.http_server = MediaHTTPServer(
+                broker.getProperties().getPropertyWithDefault(HTTP_HOST_PROPERTY, HTTP_HOST),
+                broker.getProperties().getPropertyAsIntWithDefault(HTTP_PORT_PROPERTY, HTTP_PORT),
+                broker.getProperties().getPropertyAsIntWithDefault(
+                    MAX_TRANSFERS_PROPERTY, MAX_TRANSFERS))
+            self.servant.http_server.start()
+        self.servant.upload_sessions = UploadSessions("./resources", self.servant.manifest)
+        self.servant.scanner = MediaScanner(self.servant.manifest,
+            broker.getProperties().getPropertyAsIntWithDefault(SCAN_WORKERS_PROPERTY, 0))
+
+        #Revocations
+        self.servant.verifier.key = load_key(broker)
+        self.servant.auth_batcher.window = float(broker.getProperties().getPropertyWithDefault(
+            BATCH_WINDOW_PROPERTY, str(BATCH_WINDOW)))
+        stream_sync_pub = getTopic(broker, "StreamSync").getPublisher()
+        self.servant.stream_sync_prx = IceFlix.StreamSyncPrx.uncheckedCast(stream_sync_pub)
+        revocations_topic = getTopic(broker, "Revocations")
+        revocations_prx = self.adapter.addWithUUID(self.servant.revocations)
+        revocations_topic.subscribeAndGetPublisher({}, revocations_prx)
 
         time.sleep(2)
         self.announcer.announce()
-        self.servant.readMedia()
+        threading.Thread(target=self.servant.readMedia, daemon=True).start()
         logging.info(self.proxy)
 
         self.shutdownOnInterrupt()
         broker.waitForShutdown()
+        self.subscriber.stop_checks()
+        self.servant.sessions.stop()
+        self.servant.transcode_cache.stop()
+        if self.servant.http_server is not None:
+            self.servant.http_server.stop()
+            logging.info("HTTP server: %s", self.servant.http_server.stats())
         return 0
 
 